@@ -0,0 +1,67 @@
+"""
+Whether wf_agent.py should offer for another job, given what it has already
+taken on and what the host has left.
+"""
+import math
+from datetime import datetime, timedelta, timezone
+
+import psutil
+
+from caroni_agent.models import Job, JobOffer
+
+
+class AdmissionPolicy:
+    """
+    An outstanding JobOffer holds a place as if it were already a Job, so we
+    can't be accepted for more than we can take.  An offer gives its place
+    back when it's accepted (becoming a Job), rejected (jfor_process deletes
+    it), or expires.
+
+    We take on at most the executor's slots plus queue_depth jobs, and none
+    while the host is short of CPU or memory.
+    """
+    def __init__(self, executor, queue_depth, max_cpu_percent,
+                 min_free_memory_mb):
+        self.executor = executor
+        self.queue_depth = queue_depth
+        self.max_cpu_percent = max_cpu_percent
+        self.min_free_memory = min_free_memory_mb * 1024 * 1024
+        # The first reading is meaningless; this sets the baseline
+        psutil.cpu_percent(interval=None)
+
+    def committed(self):
+        """ Jobs we have taken on or offered for, and not yet finished """
+        now = datetime.now(tz=timezone.utc)
+        jobs = Job.objects.filter(
+            state__in=["pending", "queued", "running"]).count()
+        offers = JobOffer.objects.filter(expires_at__gt=now).count()
+        return jobs + offers
+
+    def check(self):
+        """
+        Returns (None, estimated start) if we can offer for another job, else
+        (the reason not, None).
+        """
+        committed = self.committed()
+        if committed >= self.executor.slots + self.queue_depth:
+            return f"At capacity ({committed} jobs taken on or offered)", None
+
+        cpu = psutil.cpu_percent(interval=None)
+        if cpu > self.max_cpu_percent:
+            return f"Host CPU busy ({cpu:.0f}%)", None
+
+        available = psutil.virtual_memory().available
+        if available < self.min_free_memory:
+            return f"Host memory low ({available // (1024 * 1024)}MB free)", None
+
+        return None, self.estimated_start(committed)
+
+    def estimated_start(self, committed):
+        # With a slot free we'd start right away.  Otherwise, the jobs ahead
+        # of us go through the slots a mean runtime at a time.
+        now = datetime.now(tz=timezone.utc)
+        ahead = committed - self.executor.slots + 1
+        if ahead <= 0 or self.executor.mean_runtime is None:
+            return now
+        rounds = math.ceil(ahead / self.executor.slots)
+        return now + timedelta(seconds=rounds * self.executor.mean_runtime)
@@ -0,0 +1,290 @@
+"""
+Runs jobs on a batch scheduler (Slurm, or anything that can be made to look
+like it), with CARONI_AGENT_EXECUTOR=batch.  One agent can then front far more
+jobs than it could run itself, without a process or thread per job.
+
+Each job becomes a script under CARONI_AGENT_BATCH_DIR, which must be visible
+to the scheduler's nodes:
+
+    <job uuid>.sh        the JobType body, with its inputs exported
+    <job uuid>.stdout    \
+    <job uuid>.stderr     > written by the job
+    <job uuid>.outputs   /  (CARONI_OUTPUT_FD, see executors.py)
+
+Once the job is over and we've read what we need, its stdout and stderr are
+moved to CARONI_AGENT_LOG_DIR (and pruned along with the local jobs' logs),
+and the rest is deleted.
+
+Scripts are submitted with CARONI_AGENT_BATCH_SUBMIT (`sbatch --parsable`),
+which prints the scheduler's job id, and cancelled with
+CARONI_AGENT_BATCH_CANCEL (`scancel`) given that id.  Every CARONI_AGENT_BATCH_POLL seconds
+one CARONI_AGENT_BATCH_STATUS call (`sacct`) asks after all the jobs we're
+waiting on, given as a comma separated list of ids.  It's expected to print
+"<id>|<state>" lines.  fake_scheduler.py stands in for all of this locally.
+
+The job's name and files are given as #SBATCH directives, which sbatch takes
+as they are, without shell quoting.  So neither CARONI_AGENT_BATCH_DIR nor the
+names of JobTypes run here may have whitespace in them.
+"""
+import os
+import shlex
+import shutil
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from threading import Event, Lock, Thread
+
+from executors import (
+    Executor, JobResult, MAX_OUTPUT_LINE, emit_line, prune_log_dir)
+
+
+# Scheduler states (Slurm's) of jobs that aren't over yet.  Any other state but
+# COMPLETED means the job failed.
+ACTIVE_STATES = {
+    "PENDING", "CONFIGURING", "RUNNING", "COMPLETING", "SUSPENDED",
+    "REQUEUED", "REQUEUE_HOLD", "REQUEUE_FED", "RESIZING", "RESV_DEL_HOLD",
+    "SIGNALING", "STAGE_OUT",
+}
+# Ids per status call, to stay well inside the command line limit
+STATUS_CHUNK = 1000
+
+class BatchJobFailed(Exception):
+    pass
+
+class BatchExecutor(Executor):
+    """
+    `slots` here is how many jobs we'll have with the scheduler at once.
+    Submissions, and collecting finished jobs, run on a few threads of their
+    own, and one thread polls.
+    """
+    def __init__(self, slots, on_done, on_output, batch_dir, submit_command,
+                 status_command, cancel_command, poll_interval, tail_bytes,
+                 log_dir, log_keep_days):
+        super().__init__(slots, on_done, on_output)
+        self.batch_dir = batch_dir
+        self.log_dir = log_dir
+        self.log_keep_days = log_keep_days
+        self.submit_command = shlex.split(submit_command)
+        self.status_command = shlex.split(status_command)
+        self.cancel_command = shlex.split(cancel_command)
+        self.poll_interval = poll_interval
+        self.tail_bytes = tail_bytes
+        if any(c.isspace() for c in str(batch_dir)):
+            raise ValueError(
+                f"CARONI_AGENT_BATCH_DIR {str(batch_dir)!r} has whitespace in it")
+        os.makedirs(batch_dir, exist_ok=True)
+        os.makedirs(log_dir, exist_ok=True)
+
+        self.submitter = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="batch-submit")
+        # Scheduler job id -> (job uuid, Future); shared with the poller
+        self.waiting = {}
+        # Job uuid -> scheduler job id, and jobs cancelled before they had one
+        self.batch_ids = {}
+        self.killed = set()
+        self.lock = Lock()
+        self.stopping = Event()
+        self.poller = Thread(target=self.poll, name="batch-poll", daemon=True)
+        self.poller.start()
+
+    def path(self, job_uuid, suffix):
+        return os.path.join(self.batch_dir, f"{job_uuid}.{suffix}")
+
+    def submit(self, job_uuid, job_type, inputs):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.track(job_uuid, future)
+        if job_type.warm_workers > 0:
+            # Their bodies expect jobs on stdin; see warm.py
+            future.set_exception(BatchJobFailed(
+                f"JobType {job_type.name} is warm, which needs the local executor"))
+            return
+        if any(c.isspace() for c in job_type.name):
+            # It goes in an #SBATCH directive; see the top of this file
+            future.set_exception(BatchJobFailed(
+                f"JobType {job_type.name!r} has whitespace in its name"))
+            return
+        self.submitter.submit(
+            self.send, job_uuid, job_type.name, job_type.body, inputs, future)
+
+    def script(self, job_uuid, job_name, body, inputs):
+        lines = [
+            "#!/bin/bash",
+            f"#SBATCH --job-name=caroni-{job_name}",
+            f"#SBATCH --output={self.path(job_uuid, 'stdout')}",
+            f"#SBATCH --error={self.path(job_uuid, 'stderr')}",
+        ]
+        for name, value in inputs.items():
+            lines.append(f"export CARONI_ENV_{name}={shlex.quote(value)}")
+        lines.append(
+            f"exec {{CARONI_OUTPUT_FD}}>{shlex.quote(self.path(job_uuid, 'outputs'))}")
+        lines.append("export CARONI_OUTPUT_FD")
+        lines.append(body)
+        return "\n".join(lines) + "\n"
+
+    def send(self, job_uuid, job_name, body, inputs, future):
+        # Submitter thread
+        try:
+            script_path = self.path(job_uuid, "sh")
+            with open(script_path, "w") as f:
+                f.write(self.script(job_uuid, job_name, body, inputs))
+            proc = subprocess.run(
+                self.submit_command + [script_path],
+                capture_output=True, text=True, timeout=60)
+            if proc.returncode != 0:
+                raise BatchJobFailed(
+                    f"Submit failed ({proc.returncode}): {proc.stderr.strip()}")
+            # sbatch --parsable prints "<id>" or "<id>;<cluster>"
+            batch_id = proc.stdout.strip().split(";")[0]
+            if not batch_id:
+                raise BatchJobFailed("Submit printed no job id")
+        except Exception as e:
+            self.archive(job_uuid)
+            future.set_exception(e)
+            return
+        print(f"Job {job_uuid} is batch job {batch_id}")
+        with self.lock:
+            killed = job_uuid in self.killed
+            self.killed.discard(job_uuid)
+            if not killed:
+                self.waiting[batch_id] = (job_uuid, future)
+                self.batch_ids[job_uuid] = batch_id
+        if killed:
+            self.scancel(batch_id, job_uuid)
+            future.set_exception(BatchJobFailed(f"Batch job {batch_id} killed"))
+
+    def cancel(self, job_uuid):
+        future = self.running.get(job_uuid)
+        self.started.pop(job_uuid, None)
+        if future is None or future.done():
+            return
+        with self.lock:
+            batch_id = self.batch_ids.pop(job_uuid, None)
+            if batch_id is None:
+                # Still being submitted; send() sees to it
+                self.killed.add(job_uuid)
+                return
+            self.waiting.pop(batch_id, None)
+        self.submitter.submit(self.scancel, batch_id, job_uuid)
+        future.set_exception(BatchJobFailed(f"Batch job {batch_id} killed"))
+
+    def scancel(self, batch_id, job_uuid):
+        # Submitter thread
+        try:
+            subprocess.run(
+                self.cancel_command + [batch_id],
+                capture_output=True, timeout=60, check=True)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Could not cancel batch job {batch_id}: {e}")
+        self.archive(job_uuid)
+
+    def poll(self):
+        # Poller thread: one status call for everything we're waiting on
+        while not self.stopping.wait(self.poll_interval):
+            with self.lock:
+                batch_ids = list(self.waiting)
+            for i in range(0, len(batch_ids), STATUS_CHUNK):
+                self.check(batch_ids[i:i + STATUS_CHUNK])
+
+    def check(self, batch_ids):
+        try:
+            proc = subprocess.run(
+                self.status_command + [",".join(batch_ids)],
+                capture_output=True, text=True, timeout=60, check=True)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Batch status poll failed, will retry: {e}")
+            return
+
+        for line in proc.stdout.splitlines():
+            batch_id, _, state = line.partition("|")
+            # "CANCELLED by 1234"
+            state = state.split()[0] if state.split() else ""
+            if state in ACTIVE_STATES or not state:
+                continue
+            with self.lock:
+                job_uuid, future = self.waiting.pop(batch_id, (None, None))
+                self.batch_ids.pop(job_uuid, None)
+            if future is None:
+                continue
+            # Off the poller; moving logs to log_dir may mean copying them
+            if state == "COMPLETED":
+                self.submitter.submit(self.collect, job_uuid, future)
+            else:
+                self.submitter.submit(
+                    self.failed, job_uuid, future,
+                    f"Batch job {batch_id} ended {state}")
+
+    def tail(self, path):
+        """ (last tail_bytes of the file, whether that's all of it) """
+        try:
+            with open(path, "rb") as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(0, size - self.tail_bytes))
+                return f.read().decode(errors="replace"), size <= self.tail_bytes
+        except FileNotFoundError:
+            return "", True
+
+    def archive(self, job_uuid):
+        """
+        Move a finished job's stdout and stderr to log_dir, and delete the
+        rest of its files.  Returns where stdout and stderr are now.
+        """
+        for suffix in ("sh", "outputs"):
+            try:
+                os.remove(self.path(job_uuid, suffix))
+            except FileNotFoundError:
+                pass
+        archived = []
+        for suffix in ("stdout", "stderr"):
+            log_path = os.path.join(self.log_dir, f"{job_uuid}.{suffix}")
+            try:
+                shutil.move(self.path(job_uuid, suffix), log_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not move {self.path(job_uuid, suffix)}: {e}")
+            archived.append(log_path)
+        return archived
+
+    def failed(self, job_uuid, future, message):
+        # Submitter thread
+        stdout_path, stderr_path = self.archive(job_uuid)
+        future.set_exception(BatchJobFailed(
+            f"{message}; see {stdout_path} and {stderr_path}"))
+
+    def collect(self, job_uuid, future):
+        # Submitter thread, once the scheduler says the job is done
+        streamed = False
+        emit = partial(self.on_output, job_uuid)
+        try:
+            with open(self.path(job_uuid, "outputs"), "rb") as f:
+                for line in f:
+                    if len(line) <= MAX_OUTPUT_LINE:
+                        streamed |= emit_line(line.decode(), emit)
+        except FileNotFoundError:
+            pass
+
+        stdout, stdout_complete = self.tail(self.path(job_uuid, "stdout"))
+        stderr, _ = self.tail(self.path(job_uuid, "stderr"))
+        stdout_path, stderr_path = self.archive(job_uuid)
+        future.set_result(JobResult(
+            # Only jobs the scheduler says COMPLETED get here; any other end
+            # state is a BatchJobFailed (see check())
+            returncode=0,
+            stdout=stdout,
+            stderr=stderr,
+            stdout_complete=stdout_complete,
+            streamed=streamed,
+            stdout_path=stdout_path,
+            stderr_path=stderr_path))
+
+    def prune_logs(self):
+        # Only finished jobs' logs are moved there
+        prune_log_dir(self.log_dir, self.log_keep_days, set())
+
+    def shutdown(self):
+        # Jobs with the scheduler carry on without us
+        self.stopping.set()
+        # The poller hands work to the submitter, so it goes first
+        self.poller.join()
+        self.submitter.shutdown(wait=True)
@@ -0,0 +1,68 @@
+"""
+Checks that the agent's hot queries are planned with indexes, not table scans,
+so they hold up as the tables grow.  Exits non-zero if any aren't.
+
+    python manage.py check_query_plans
+
+Works against SQLite and PostgreSQL.  PostgreSQL is told to avoid sequential
+scans (enable_seqscan off) for the check, as it would rightly pick them for
+small tables anyway; one that still shows up has no index to use instead.
+"""
+import re
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from caroni_agent.models import Job, JobOffer, JobType
+
+
+def hot_queries():
+    # The values don't matter, only the shape of the query
+    now = datetime.now(tz=timezone.utc)
+    return {
+        "oldest queued job (main loop)":
+            Job.objects.filter(state="queued").order_by("queued_at")[:1],
+        "JobTypes by name (jfr_process)":
+            JobType.objects.filter(name="a_job_type"),
+        "live offers (AdmissionPolicy)":
+            JobOffer.objects.filter(expires_at__gt=now),
+        "expired offers (reap_offers)":
+            JobOffer.objects.filter(expires_at__lte=now),
+    }
+
+def table_scans(plan):
+    """ The tables a query plan reads from start to end """
+    if connection.vendor == "postgresql":
+        return re.findall(r"Seq Scan on (\w+)", plan)
+    # SQLite: "SCAN t" is a table scan, "SCAN t USING INDEX i" isn't
+    return [
+        match.group(1) for match in re.finditer(r"\bSCAN (\w+)(.*)", plan)
+        if "USING" not in match.group(2)
+    ]
+
+class Command(BaseCommand):
+    help = "Check the agent's hot queries use indexes"
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ("postgresql", "sqlite"):
+            raise CommandError(f"Don't know how to read {connection.vendor} plans")
+
+        failed = []
+        with transaction.atomic():
+            if connection.vendor == "postgresql":
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+
+            for name, queryset in hot_queries().items():
+                plan = queryset.explain()
+                scans = table_scans(plan)
+                if scans:
+                    failed.append(name)
+                    self.stdout.write(self.style.ERROR(
+                        f"{name}: scans {', '.join(scans)}\n{plan}"))
+                else:
+                    self.stdout.write(f"{name}: ok")
+
+        if failed:
+            raise CommandError(f"{len(failed)} hot queries scan tables")
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caroni_agent', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='correlation_id',
+            field=models.CharField(default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 6.0 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caroni_agent', '0002_job_correlation_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(condition=models.Q(('state', 'queued')), fields=['queued_at'], name='job_queued_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='jobtype',
+            index=models.Index(fields=['name'], name='jobtype_name_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 14:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caroni_agent', '0003_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobtype',
+            name='warm_workers',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
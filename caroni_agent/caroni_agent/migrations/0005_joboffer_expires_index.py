@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caroni_agent', '0004_jobtype_warm_workers'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='joboffer',
+            index=models.Index(fields=['expires_at'], name='joboffer_expires_idx'),
+        ),
+    ]
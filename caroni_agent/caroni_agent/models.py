@@ -2,7 +2,7 @@ import uuid
 
 from datetime import datetime, timezone
 
-from django.db import models
+from django.db import models, transaction
 from django_fsm import FSMField, transition
 
 
@@ -10,6 +10,15 @@ class JobType(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4)
     name = models.CharField(max_length=255, default="")
     body = models.TextField(default="")
+    # Above 0, body is a worker that serves job after job, and this many are
+    # kept ready; see warm.py
+    warm_workers = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # jfr_process looks JobTypes up by name
+            models.Index(fields=["name"], name="jobtype_name_idx"),
+        ]
 
     def __str__(self):
         return f"{self.name}"
@@ -56,13 +65,31 @@ class JobOffer(models.Model):
     job_type_name = models.CharField(max_length=255, default="")
     expires_at = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            # Live offers for AdmissionPolicy, and expired ones for reap_offers()
+            models.Index(fields=["expires_at"], name="joboffer_expires_idx"),
+        ]
+
 class Job(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4)
     reply_to = models.CharField(max_length=255, default="")
+    # Echoed back on everything we send about this Job
+    correlation_id = models.CharField(max_length=255, default="")
     job_type = models.ForeignKey(JobType, on_delete=models.CASCADE, null=True)
     state = FSMField(default="pending", protected=True)
     queued_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # The oldest queued job, for the main loop.  Partial, so it only
+            # ever holds the queued ones (PostgreSQL and SQLite).
+            models.Index(
+                fields=["queued_at"],
+                name="job_queued_idx",
+                condition=models.Q(state="queued")),
+        ]
+
     @transition(field=state, source="pending", target="queued")
     def queue(self):
         self.queued_at = datetime.now(tz=timezone.utc)
@@ -89,29 +116,36 @@ class Job(models.Model):
         for an_input in self.job_type.inputs.all():
             self.inputs.create(job=self, name=an_input.name)
 
-    def deliver_input(self, name="", value=""):
-        an_input = self.inputs.get(name=name)
-        # Ignore any inputs we already received
-        if an_input.state != "available":
-            an_input.value=value
-            an_input.deliver()
-            an_input.save()
-            # FIXME For now, we're forcing this right to available, but we need an
-            # internal call back, or timer loop to "move" data and confirm it's
-            # available.
-            an_input.mark_available()
-            an_input.save()
-        
+    @transaction.atomic
+    def deliver_inputs(self, values):
+        """
+        Takes {input name: value}, as from one JobDataAvailable, and delivers
+        them all at once.
+        """
+        inputs = list(self.inputs.all())
+        unknown = set(values) - {an_input.name for an_input in inputs}
+        if unknown:
+            raise JobInput.DoesNotExist(
+                f"Job {self.uuid} has no inputs {sorted(unknown)}")
+
+        delivered = []
+        for an_input in inputs:
+            # Ignore any inputs we already received
+            if an_input.name in values and an_input.state != "available":
+                an_input.value = values[an_input.name]
+                an_input.deliver()
+                # FIXME For now, we're forcing this right to available, but we
+                # need an internal call back, or timer loop to "move" data and
+                # confirm it's available.
+                an_input.mark_available()
+                delivered.append(an_input)
+        JobInput.objects.bulk_update(delivered, ["value", "state"])
+
         # Do we have all the inputs?  If so, go ahead and queue.  This will
         # almost assuredly be more complicated in the future, given the
         # consideration of internal needs like license tokens (yet not the
         # resource itself)
-        go_for_queue = True
-        for an_input in self.inputs.all():
-            if an_input.state not in ["available"]:
-                go_for_queue = False
-
-        if go_for_queue:
+        if all(an_input.state == "available" for an_input in inputs):
             self.queue()
             self.save()
 
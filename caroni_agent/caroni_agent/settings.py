@@ -132,3 +132,73 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
 
 STATIC_URL = 'static/'
+
+
+# Caroni
+# Knobs for wf_agent.py; each can be overridden from the environment.
+
+# Messages the broker hands us before we've acked the earlier ones.  Keeps a
+# burst of JobFulfillmentRequests queued at the broker rather than here.
+CARONI_AGENT_PREFETCH = int(os.environ.get("CARONI_AGENT_PREFETCH", 8))
+
+# How many jobs run at once
+CARONI_AGENT_SLOTS = int(os.environ.get("CARONI_AGENT_SLOTS", os.cpu_count() or 1))
+
+# When to stop offering for more jobs (see admission.py).  Jobs taken on or
+# offered for beyond those running, and the host headroom we leave.
+CARONI_AGENT_QUEUE_DEPTH = int(
+    os.environ.get("CARONI_AGENT_QUEUE_DEPTH", CARONI_AGENT_SLOTS))
+CARONI_AGENT_MAX_CPU_PERCENT = float(
+    os.environ.get("CARONI_AGENT_MAX_CPU_PERCENT", 90))
+CARONI_AGENT_MIN_FREE_MEMORY_MB = int(
+    os.environ.get("CARONI_AGENT_MIN_FREE_MEMORY_MB", 256))
+
+# Seconds an offer holds a place for, and between clear outs of expired offers
+CARONI_AGENT_OFFER_TTL = int(os.environ.get("CARONI_AGENT_OFFER_TTL", 900))
+CARONI_AGENT_OFFER_REAP = float(os.environ.get("CARONI_AGENT_OFFER_REAP", 60))
+
+# Seconds between re-reads of the JobTypes (see job_types.py)
+CARONI_AGENT_JOB_TYPE_REFRESH = float(
+    os.environ.get("CARONI_AGENT_JOB_TYPE_REFRESH", 30))
+
+# Print what's been handled (Dispatcher.summary()) this often, in seconds; 0
+# never does
+CARONI_AGENT_STATS_INTERVAL = float(
+    os.environ.get("CARONI_AGENT_STATS_INTERVAL", 300))
+
+# Where job stdout/stderr go (see executors.JobLog).  Each stream is rotated at
+# LOG_MAX_BYTES, keeping LOG_BACKUPS old files, and only its last
+# LOG_TAIL_BYTES are kept in memory.
+CARONI_AGENT_LOG_DIR = os.environ.get("CARONI_AGENT_LOG_DIR", BASE_DIR / "job_logs")
+CARONI_AGENT_LOG_MAX_BYTES = int(
+    os.environ.get("CARONI_AGENT_LOG_MAX_BYTES", 10 * 1024 * 1024))
+CARONI_AGENT_LOG_BACKUPS = int(os.environ.get("CARONI_AGENT_LOG_BACKUPS", 2))
+CARONI_AGENT_LOG_TAIL_BYTES = int(
+    os.environ.get("CARONI_AGENT_LOG_TAIL_BYTES", 16 * 1024))
+# Logs untouched for LOG_KEEP_DAYS are deleted (0 keeps them all); the log dir
+# is checked every LOG_PRUNE seconds
+CARONI_AGENT_LOG_KEEP_DAYS = float(
+    os.environ.get("CARONI_AGENT_LOG_KEEP_DAYS", 7))
+CARONI_AGENT_LOG_PRUNE = float(os.environ.get("CARONI_AGENT_LOG_PRUNE", 3600))
+
+# Seconds a killed job (JobKill) has to exit after SIGTERM, before SIGKILL
+CARONI_AGENT_KILL_GRACE = float(os.environ.get("CARONI_AGENT_KILL_GRACE", 0.5))
+
+# Warm workers (see warm.py) are replaced after this many jobs, or once they're
+# using more than this much memory
+CARONI_AGENT_WARM_MAX_JOBS = int(os.environ.get("CARONI_AGENT_WARM_MAX_JOBS", 1000))
+CARONI_AGENT_WARM_MAX_RSS_MB = int(
+    os.environ.get("CARONI_AGENT_WARM_MAX_RSS_MB", 512))
+
+# What runs the jobs: "local" subprocesses, or "batch" for a batch scheduler
+# (see batch.py, and fake_scheduler.py for trying it out)
+CARONI_AGENT_EXECUTOR = os.environ.get("CARONI_AGENT_EXECUTOR", "local")
+CARONI_AGENT_BATCH_SLOTS = int(os.environ.get("CARONI_AGENT_BATCH_SLOTS", 1000))
+CARONI_AGENT_BATCH_DIR = os.environ.get("CARONI_AGENT_BATCH_DIR", BASE_DIR / "batch_jobs")
+CARONI_AGENT_BATCH_SUBMIT = os.environ.get(
+    "CARONI_AGENT_BATCH_SUBMIT", "sbatch --parsable")
+CARONI_AGENT_BATCH_STATUS = os.environ.get(
+    "CARONI_AGENT_BATCH_STATUS",
+    "sacct --noheader --parsable2 --allocations --format=JobID,State --jobs")
+CARONI_AGENT_BATCH_CANCEL = os.environ.get("CARONI_AGENT_BATCH_CANCEL", "scancel")
+CARONI_AGENT_BATCH_POLL = float(os.environ.get("CARONI_AGENT_BATCH_POLL", 10))
@@ -0,0 +1,409 @@
+"""
+Where wf_agent.py runs job bodies, so that it can keep serving AMQP while they
+run.
+
+A job body can hand over its outputs as soon as each is ready by writing a JSON
+object per line to the file descriptor in $CARONI_OUTPUT_FD:
+
+    echo '{"word_count": "12"}' >&$CARONI_OUTPUT_FD
+
+A body that writes nothing there has its stdout read as one JSON object once
+it exits, as before, provided it's small enough to fit in the tail we keep.
+
+Otherwise stdout and stderr go to per-job log files (see JobLog), and only their
+last few KB are kept in memory.
+"""
+import json
+import os
+import selectors
+import signal
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from threading import Lock, Timer
+from time import monotonic, time
+
+from warm import WarmJobFailed, WarmPool
+
+
+# Longest line we'll take from CARONI_OUTPUT_FD
+MAX_OUTPUT_LINE = 64 * 1024
+
+@dataclass
+class JobResult:
+    returncode: int
+    # Tails only; the rest is in the log files
+    stdout: str
+    stderr: str
+    # Whether stdout is all there, and not just its tail
+    stdout_complete: bool
+    # Whether any outputs came over CARONI_OUTPUT_FD
+    streamed: bool
+    stdout_path: str
+    stderr_path: str
+
+class JobLog:
+    """
+    Where one of a job's streams goes.  Everything is written to path, which is
+    rotated to path.1, path.2, ... once it reaches max_bytes, keeping `backups`
+    of them; the last tail_bytes are also kept in memory.
+    """
+    def __init__(self, path, max_bytes, backups, tail_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.tail_bytes = tail_bytes
+        self.tail = bytearray()
+        self.size = 0 # Everything written, rotated or not
+        self.file = open(path, "wb")
+        self.file_size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.tail += data
+        del self.tail[:-self.tail_bytes]
+
+        while data:
+            if self.file_size >= self.max_bytes:
+                self.rotate()
+            room = self.max_bytes - self.file_size
+            self.file.write(data[:room])
+            self.file_size += len(data[:room])
+            data = data[room:]
+
+    def rotate(self):
+        self.file.close()
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "wb")
+        self.file_size = 0
+
+    def close(self):
+        self.file.close()
+
+    def text(self):
+        return self.tail.decode(errors="replace")
+
+    def complete(self):
+        return self.size <= self.tail_bytes
+
+def emit_line(line, emit):
+    line = line.strip()
+    if not line:
+        return False
+    try:
+        outputs = json.loads(line)
+    except ValueError:
+        outputs = None
+    if not isinstance(outputs, dict):
+        print(f"Ignoring output line that isn't a JSON object: {line[:200]!r}")
+        return False
+    emit(outputs)
+    return True
+
+def run_body(body, env, emit, stdout_log, stderr_log, on_start):
+    """
+    Run a job body, calling emit({name: value}) for each line it writes to
+    CARONI_OUTPUT_FD as it writes it.  stdout and stderr go to the JobLogs.
+    on_start(proc) is called once the body is running.
+    """
+    result_r, result_w = os.pipe()
+    try:
+        proc = subprocess.Popen(
+            ["bash", "-c", body],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env={**env, "CARONI_OUTPUT_FD": str(result_w)},
+            pass_fds=(result_w,),
+            # Its own process group, for kill_group()
+            start_new_session=True)
+    except BaseException:
+        os.close(result_r)
+        stdout_log.close()
+        stderr_log.close()
+        raise
+    finally:
+        # Only the job writes to it, so we see EOF when the job is done
+        os.close(result_w)
+    on_start(proc)
+
+    logs = {proc.stdout.fileno(): stdout_log, proc.stderr.fileno(): stderr_log}
+    partial_line = b""
+    overlong = False
+    streamed = False
+    try:
+        with selectors.DefaultSelector() as selector:
+            for fd in (*logs, result_r):
+                selector.register(fd, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        selector.unregister(key.fd)
+                    elif key.fd == result_r:
+                        *lines, partial_line = (partial_line + data).split(b"\n")
+                        for line in lines:
+                            if overlong:
+                                overlong = False # The end of it
+                            else:
+                                streamed |= emit_line(line.decode(), emit)
+                        if len(partial_line) > MAX_OUTPUT_LINE:
+                            print(f"Ignoring output line over {MAX_OUTPUT_LINE} bytes")
+                            partial_line = b""
+                            overlong = True
+                    else:
+                        logs[key.fd].write(data)
+        if not overlong:
+            streamed |= emit_line(partial_line.decode(), emit)
+    finally:
+        os.close(result_r)
+        proc.stdout.close()
+        proc.stderr.close()
+        stdout_log.close()
+        stderr_log.close()
+    returncode = proc.wait()
+
+    return JobResult(
+        returncode=returncode,
+        stdout=stdout_log.text(),
+        stderr=stderr_log.text(),
+        stdout_complete=stdout_log.complete(),
+        streamed=streamed,
+        stdout_path=stdout_log.path,
+        stderr_path=stderr_log.path)
+
+def run_warm(warm_pool, job_type, job_uuid, inputs, emit, on_start):
+    """ Run a job on one of its JobType's warm workers (see warm.py) """
+    worker = warm_pool.checkout(job_type)
+    try:
+        # Killing the job kills the worker, which is then replaced
+        on_start(worker.proc)
+        outputs = worker.run(job_uuid, inputs)
+    except WarmJobFailed as e:
+        # An ordinary failure; the worker's good for the next job
+        warm_pool.checkin(worker, job_type)
+        return JobResult(
+            returncode=1,
+            stdout="",
+            stderr=str(e),
+            stdout_complete=True,
+            streamed=False,
+            stdout_path=worker.log.path,
+            stderr_path=worker.log.path)
+    except BaseException:
+        # Can't know what state it's in
+        worker.stop()
+        raise
+    warm_pool.checkin(worker, job_type)
+    emit(outputs)
+
+    return JobResult(
+        returncode=0,
+        stdout="",
+        stderr="",
+        stdout_complete=True,
+        streamed=True,
+        stdout_path=worker.log.path,
+        stderr_path=worker.log.path)
+
+def prune_log_dir(log_dir, keep_days, in_use):
+    """
+    Delete the files in log_dir not written to for keep_days (0 keeps them
+    all), except those in use.  Files go by the name up to the first dot:
+    "<job uuid>.stdout.1" by the job uuid, "warm-<uuid>-<n>.log" by
+    "warm-<uuid>-<n>".
+    """
+    if keep_days <= 0:
+        return
+    cutoff = time() - keep_days * 24 * 3600
+    pruned = 0
+    with os.scandir(log_dir) as entries:
+        for entry in entries:
+            if entry.name.split(".")[0] in in_use:
+                continue
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    pruned += 1
+            except FileNotFoundError:
+                pass
+    if pruned:
+        print(f"Pruned {pruned} old job log(s)")
+
+def kill_group(proc, grace):
+    """
+    SIGTERM a job's process group, and SIGKILL it if it's still about after
+    grace seconds.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    Timer(grace, kill_group_now, (proc,)).start()
+
+def kill_group_now(proc):
+    # Not reaped yet, so the pid (and group) are still its
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+class Executor:
+    """
+    What wf_agent.py runs jobs on.  submit() starts a job, and runs it at
+    whatever pace suits; on_done(job_uuid, future) is called with a Future of
+    its JobResult when it's over, and on_output(job_uuid, outputs) each time
+    it hands over outputs early.  Both may be called from any thread, and are
+    expected to hand things back to the main thread.
+
+    At most `slots` jobs are submitted at once.  submit(), free_slots() and
+    finished() are for the main thread only.
+    """
+    def __init__(self, slots, on_done, on_output):
+        self.slots = slots
+        self.on_done = on_done
+        self.on_output = on_output
+        # job uuid -> Future of its JobResult
+        self.running = {}
+        self.started = {}
+        # Running average of how long bodies take, in seconds (None until one
+        # has finished); see AdmissionPolicy
+        self.mean_runtime = None
+
+    def free_slots(self):
+        return self.slots - len(self.running)
+
+    def submit(self, job_uuid, job_type, inputs):
+        raise NotImplementedError
+
+    def cancel(self, job_uuid):
+        """
+        Stop a job for good.  on_done() is still called for it in time, and
+        its slot is only free once the main thread has taken that (finished()),
+        so a job that's slow to die doesn't leave the next one waiting on it.
+        """
+        raise NotImplementedError
+
+    def track(self, job_uuid, future):
+        self.running[job_uuid] = future
+        self.started[job_uuid] = monotonic()
+        future.add_done_callback(partial(self.on_done, job_uuid))
+
+    def finished(self, job_uuid):
+        # The main thread has taken the result
+        self.running.pop(job_uuid, None)
+        started = self.started.pop(job_uuid, None)
+        if started is not None:
+            runtime = monotonic() - started
+            if self.mean_runtime is None:
+                self.mean_runtime = runtime
+            else:
+                self.mean_runtime += (runtime - self.mean_runtime) / 10
+
+    def job_types_changed(self, job_types):
+        # The JobTypes were (re)read; see refresh_job_types()
+        pass
+
+    def prune_logs(self):
+        # Every so often, from the main thread; see wf_agent.prune_logs()
+        pass
+
+    def shutdown(self):
+        pass
+
+class LocalExecutor(Executor):
+    """
+    Runs job bodies as local subprocesses, the default.  The pool threads only
+    wait on the subprocess.  Cancelled jobs have kill_grace seconds to exit
+    before they're killed outright.
+
+    Each job's stdout and stderr go to <job uuid>.stdout and .stderr under
+    log_dir; see JobLog for the rest.  Jobs of warm JobTypes go to warm_pool
+    instead.  Logs nothing has written to for log_keep_days are deleted by
+    prune_logs().
+    """
+    def __init__(self, slots, on_done, on_output, log_dir, log_max_bytes,
+                 log_backups, log_tail_bytes, log_keep_days, warm_max_jobs,
+                 warm_max_rss_mb, kill_grace):
+        super().__init__(slots, on_done, on_output)
+        self.kill_grace = kill_grace
+        self.log_keep_days = log_keep_days
+        # job uuid -> its Popen, while it runs; shared with the pool threads
+        self.procs = {}
+        self.killed = set()
+        self.lock = Lock()
+        self.log_dir = log_dir
+        self.open_log = partial(
+            JobLog, max_bytes=log_max_bytes, backups=log_backups,
+            tail_bytes=log_tail_bytes)
+        os.makedirs(log_dir, exist_ok=True)
+        self.warm_pool = WarmPool(
+            self.open_log, log_dir, warm_max_jobs, warm_max_rss_mb,
+            MAX_OUTPUT_LINE)
+        self.pool = ThreadPoolExecutor(
+            max_workers=slots, thread_name_prefix="job")
+
+    def submit(self, job_uuid, job_type, inputs):
+        emit = partial(self.on_output, job_uuid)
+        if job_type.warm_workers > 0:
+            future = self.pool.submit(
+                self.run, job_uuid, run_warm, self.warm_pool, job_type,
+                job_uuid, inputs, emit)
+        else:
+            env = {"CARONI_ENV_" + name: value for name, value in inputs.items()}
+            path = os.path.join(self.log_dir, str(job_uuid))
+            future = self.pool.submit(
+                self.run, job_uuid, run_body, job_type.body, env, emit,
+                self.open_log(f"{path}.stdout"),
+                self.open_log(f"{path}.stderr"))
+        self.track(job_uuid, future)
+
+    def run(self, job_uuid, run_job, *args):
+        # Pool thread
+        try:
+            return run_job(*args, partial(self.started_proc, job_uuid))
+        finally:
+            with self.lock:
+                self.procs.pop(job_uuid, None)
+                self.killed.discard(job_uuid)
+
+    def started_proc(self, job_uuid, proc):
+        # Pool thread; the job may have been cancelled before it got going
+        with self.lock:
+            self.procs[job_uuid] = proc
+            killed = job_uuid in self.killed
+        if killed:
+            kill_group(proc, self.kill_grace)
+
+    def cancel(self, job_uuid):
+        # Still running until it's finished(); its pool thread is busy till then
+        future = self.running.get(job_uuid)
+        self.started.pop(job_uuid, None)
+        if future is None or future.done():
+            return
+        if future.cancel():
+            return # Never started
+        with self.lock:
+            self.killed.add(job_uuid)
+            proc = self.procs.get(job_uuid)
+        if proc is not None:
+            kill_group(proc, self.kill_grace)
+
+    def job_types_changed(self, job_types):
+        self.warm_pool.prespawn(job_types)
+
+    def prune_logs(self):
+        # A quiet job or idle worker may not have written for days, so theirs
+        # are kept whatever their age
+        in_use = {str(job_uuid) for job_uuid in self.running}
+        in_use |= self.warm_pool.log_names()
+        prune_log_dir(self.log_dir, self.log_keep_days, in_use)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+        self.warm_pool.shutdown()
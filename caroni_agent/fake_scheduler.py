@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Just enough of sbatch, sacct and scancel to run the batch executor (batch.py)
+on one machine, without a cluster:
+
+    CARONI_AGENT_EXECUTOR=batch \
+    CARONI_AGENT_BATCH_SUBMIT="python3 fake_scheduler.py submit" \
+    CARONI_AGENT_BATCH_STATUS="python3 fake_scheduler.py status" \
+    CARONI_AGENT_BATCH_CANCEL="python3 fake_scheduler.py cancel" \
+    python wf_agent.py
+
+Jobs run straight away, in the background, and their state is kept as files
+under $FAKE_SCHEDULER_DIR (/tmp/caroni-fake-scheduler by default).
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+
+
+spool = os.environ.get("FAKE_SCHEDULER_DIR", "/tmp/caroni-fake-scheduler")
+
+def state_path(batch_id, what):
+    return os.path.join(spool, f"{batch_id}.{what}")
+
+def write(path, text):
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+def read(path, default=""):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return default
+
+def directives(script):
+    # The #SBATCH --output/--error lines
+    found = {}
+    with open(script) as f:
+        for line in f:
+            if line.startswith("#SBATCH --") and "=" in line:
+                key, _, value = line[len("#SBATCH --"):].strip().partition("=")
+                found[key] = value
+    return found
+
+def submit(script):
+    os.makedirs(spool, exist_ok=True)
+    batch_id = str(time.time_ns())
+    write(state_path(batch_id, "state"), "PENDING")
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "run", batch_id, script],
+        start_new_session=True,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    print(batch_id)
+
+def run(batch_id, script):
+    found = directives(script)
+    with open(found.get("output", os.devnull), "wb") as out, \
+         open(found.get("error", os.devnull), "wb") as err:
+        proc = subprocess.Popen(
+            ["bash", script], stdin=subprocess.DEVNULL, stdout=out, stderr=err,
+            start_new_session=True)
+        write(state_path(batch_id, "pid"), str(proc.pid))
+        write(state_path(batch_id, "state"), "RUNNING")
+        returncode = proc.wait()
+    if read(state_path(batch_id, "state")) != "CANCELLED":
+        write(state_path(batch_id, "state"),
+              "COMPLETED" if returncode == 0 else "FAILED")
+
+def status(batch_ids):
+    for batch_id in batch_ids.split(","):
+        state = read(state_path(batch_id, "state"))
+        if state:
+            print(f"{batch_id}|{state}")
+
+def cancel(batch_id):
+    write(state_path(batch_id, "state"), "CANCELLED")
+    pid = read(state_path(batch_id, "pid"))
+    if pid:
+        try:
+            os.killpg(int(pid), signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+if __name__ == "__main__":
+    command, *args = sys.argv[1:]
+    {"submit": submit, "run": run, "status": status, "cancel": cancel}[command](*args)
@@ -0,0 +1,57 @@
+"""
+What wf_agent.py can run, held in memory so that a JobFulfillmentRequest can
+be matched without going to the database.
+"""
+from django.db.models.signals import post_delete, post_save
+
+from caroni_agent.models import JobType, JobTypeInput
+
+
+class JobTypeIndex:
+    """
+    (JobType name, frozenset of its input names) -> JobType.
+
+    Saves and deletes in this process drop the index, to be rebuilt on next
+    use.  JobTypes are mostly edited through the admin, in another process, so
+    wf_agent.py also rebuilds it every CARONI_AGENT_JOB_TYPE_REFRESH seconds.
+    """
+    def __init__(self):
+        self.index = None
+
+    def rebuild(self):
+        index = {}
+        for job_type in JobType.objects.prefetch_related("inputs"):
+            key = (
+                job_type.name,
+                frozenset(an_input.name for an_input in job_type.inputs.all()))
+            index.setdefault(key, job_type)
+        self.index = index
+
+    def invalidate(self, **kwargs):
+        self.index = None
+
+    def names(self):
+        if self.index is None:
+            self.rebuild()
+        return {name for name, _ in self.index}
+
+    def job_types(self):
+        if self.index is None:
+            self.rebuild()
+        return list(self.index.values())
+
+    def match(self, name, input_names):
+        """ The JobType for a request, or None if we have none """
+        if self.index is None:
+            self.rebuild()
+        return self.index.get((name, frozenset(input_names)))
+
+job_type_index = JobTypeIndex()
+
+for model in (JobType, JobTypeInput):
+    post_save.connect(
+        job_type_index.invalidate, sender=model,
+        dispatch_uid=f"job_type_index_save_{model.__name__}")
+    post_delete.connect(
+        job_type_index.invalidate, sender=model,
+        dispatch_uid=f"job_type_index_delete_{model.__name__}")
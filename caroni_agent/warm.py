@@ -0,0 +1,241 @@
+"""
+Warm workers, for JobTypes whose jobs are over so quickly that starting a
+fresh `bash -c` for each would be most of the work.
+
+A JobType with warm_workers > 0 has a body that runs as a long lived worker,
+serving one job after another.  For each job the worker is sent a line on its
+stdin:
+
+    {"job": "<job uuid>", "inputs": {"text": "..."}}
+
+and answers with a line on the file descriptor in $CARONI_OUTPUT_FD:
+
+    {"outputs": {"outSB": "..."}}    or    {"error": "what went wrong"}
+
+An error fails just the job; the worker carries on with the next one.  A
+worker that breaks the protocol (exits, answers with something that isn't a
+JSON object, or a line longer than the executor's MAX_OUTPUT_LINE) is
+replaced.
+
+Anything the worker prints on stdout or stderr goes to its log.  Workers are
+replaced after CARONI_AGENT_WARM_MAX_JOBS jobs, or once they (and anything
+they've started) use more than CARONI_AGENT_WARM_MAX_RSS_MB.
+"""
+import json
+import os
+import subprocess
+from threading import Lock, Thread
+
+import psutil
+
+
+RSS_CHECK_EVERY = 20
+
+class WarmWorkerError(Exception):
+    pass
+
+class WarmJobFailed(Exception):
+    """ The worker answered with an error; the worker itself is fine """
+    pass
+
+class WarmWorker:
+    def __init__(self, key, body, log, max_line):
+        self.key = key
+        self.max_line = max_line
+        self.jobs = 0
+        result_r, result_w = os.pipe()
+        try:
+            self.proc = subprocess.Popen(
+                ["bash", "-c", body],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                env={"CARONI_OUTPUT_FD": str(result_w)},
+                pass_fds=(result_w,),
+                start_new_session=True)
+        except BaseException:
+            os.close(result_r)
+            raise
+        finally:
+            os.close(result_w)
+        self.results = os.fdopen(result_r, "rb")
+        self.log = log
+        Thread(
+            target=self.copy_log, name=f"warm-log-{self.proc.pid}",
+            daemon=True).start()
+
+    def copy_log(self):
+        for data in iter(lambda: self.proc.stdout.read1(65536), b""):
+            self.log.write(data)
+        self.log.close()
+
+    def run(self, job_uuid, inputs):
+        """
+        Returns the job's outputs.  Raises WarmJobFailed if the job failed,
+        and WarmWorkerError if the worker did.
+        """
+        request = json.dumps({"job": str(job_uuid), "inputs": inputs})
+        try:
+            self.proc.stdin.write(request.encode() + b"\n")
+            self.proc.stdin.flush()
+        except OSError as e:
+            raise WarmWorkerError(f"Worker {self.proc.pid} is gone: {e}")
+        line = self.results.readline(self.max_line + 1)
+        if not line:
+            raise WarmWorkerError(f"Worker {self.proc.pid} exited mid job")
+        if len(line) > self.max_line:
+            raise WarmWorkerError(
+                f"Worker {self.proc.pid} answered with over {self.max_line} bytes")
+        self.jobs += 1
+
+        try:
+            response = json.loads(line)
+        except ValueError:
+            response = None
+        if not isinstance(response, dict):
+            raise WarmWorkerError(f"Bad response from worker: {line[:200]!r}")
+        if "error" in response:
+            raise WarmJobFailed(str(response["error"]))
+        return response.get("outputs", {})
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def rss(self):
+        try:
+            process = psutil.Process(self.proc.pid)
+            return sum(
+                p.memory_info().rss
+                for p in [process, *process.children(recursive=True)])
+        except psutil.Error:
+            return 0
+
+    def stop(self):
+        # Closing stdin is the worker's cue to exit
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.results.close()
+
+class WarmPool:
+    """
+    Idle workers for each warm JobType, keyed on the JobType and its body so
+    that an edited body gets fresh workers.  Up to job_type.warm_workers are
+    kept idle; more are started when jobs of the type run at once, and stopped
+    when they're done.
+
+    checkout() and checkin() are called from the executor's threads; prespawn()
+    from the main thread.
+    """
+    def __init__(self, open_log, log_dir, max_jobs, max_rss_mb, max_line):
+        self.open_log = open_log
+        self.log_dir = log_dir
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.max_line = max_line
+        # key -> [idle WarmWorker]
+        self.idle = {}
+        # Every worker started, idle or not, until it's found dead
+        self.workers = set()
+        self.spawned = 0
+        self.lock = Lock()
+
+    def key_for(self, job_type):
+        return (job_type.uuid, job_type.body)
+
+    def spawn(self, job_type):
+        with self.lock:
+            self.spawned += 1
+            n = self.spawned
+        # By uuid; names can be anything, "/" included
+        log = self.open_log(
+            os.path.join(self.log_dir, f"warm-{job_type.uuid}-{n}.log"))
+        try:
+            worker = WarmWorker(
+                self.key_for(job_type), job_type.body, log, self.max_line)
+        except BaseException:
+            log.close()
+            raise
+        with self.lock:
+            self.workers.add(worker)
+        return worker
+
+    def log_names(self):
+        """ The log file names (up to the first dot) of live workers """
+        with self.lock:
+            self.workers = {w for w in self.workers if w.alive()}
+            workers = list(self.workers)
+        return {
+            os.path.basename(worker.log.path).split(".")[0]
+            for worker in workers}
+
+    def checkout(self, job_type):
+        key = self.key_for(job_type)
+        dead = []
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                worker = idle.pop()
+                if worker.alive():
+                    break
+                dead.append(worker)
+            else:
+                worker = None
+        for a_worker in dead:
+            a_worker.stop()
+        return worker or self.spawn(job_type)
+
+    def checkin(self, worker, job_type):
+        """ Keep the worker for another job, or retire it """
+        # Looking up RSS costs more than a job, so only every so often
+        if (worker.alive() and worker.jobs < self.max_jobs
+                and (worker.jobs % RSS_CHECK_EVERY
+                     or worker.rss() <= self.max_rss)):
+            with self.lock:
+                idle = self.idle.setdefault(worker.key, [])
+                if len(idle) < job_type.warm_workers:
+                    idle.append(worker)
+                    return
+        worker.stop()
+
+    def prespawn(self, job_types):
+        """
+        Top up the idle workers of each warm JobType, and stop those of
+        JobTypes that are gone or no longer warm.
+        """
+        wanted = {
+            self.key_for(job_type): job_type
+            for job_type in job_types if job_type.warm_workers > 0}
+        retired = []
+        with self.lock:
+            for key in list(self.idle):
+                if key not in wanted:
+                    retired.extend(self.idle.pop(key))
+        for worker in retired:
+            worker.stop()
+
+        for key, job_type in wanted.items():
+            with self.lock:
+                missing = job_type.warm_workers - len(self.idle.get(key, []))
+            for _ in range(missing):
+                # One JobType that won't start mustn't take the agent with it
+                try:
+                    worker = self.spawn(job_type)
+                except Exception as e:
+                    print(f"Could not start a warm worker for {job_type.name}: {e}")
+                    break
+                with self.lock:
+                    self.idle.setdefault(key, []).append(worker)
+
+    def shutdown(self):
+        with self.lock:
+            workers = [w for idle in self.idle.values() for w in idle]
+            self.idle = {}
+        for worker in workers:
+            worker.stop()
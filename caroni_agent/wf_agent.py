@@ -4,19 +4,24 @@ from random import uniform, choices
 from datetime import datetime, timezone, timedelta
 import base64
 import json
+import logging
 import uuid
 import os
-import subprocess
+from collections import deque
+from functools import partial
 from time import sleep
 
 from google.protobuf.timestamp_pb2 import Timestamp
 from google.protobuf.any_pb2 import Any
 
+from dispatch import Dispatcher
+from batch import BatchExecutor
+from executors import LocalExecutor
 from gen.workflow_messages_pb2 import (
     JobStatus, JobFulfillmentRequest, JobFulfillmentDecline,
     JobFulfillmentOffer, Signature, Site, CaroniEnvelope,
-    JobFulfillmentOfferAccept, JobAccepted, JobStatusUpdate, JobStatusRequest,
-    JobDataAvailable, JobParameter)
+    JobFulfillmentOfferAccept, JobFulfillmentOfferReject, JobAccepted, JobStatusUpdate, JobStatusRequest,
+    JobDataAvailable, JobParameter, JobKill)
 
 import pika
 
@@ -27,6 +32,15 @@ django.setup()
 
 # ... and now we can do Django!
 from caroni_agent.models import JobType, JobOffer, Job, JobInput, JobOutput
+from admission import AdmissionPolicy
+from job_types import job_type_index
+
+from django.conf import settings
+from django.db import transaction
+from django.dispatch import receiver
+from django_fsm import TransitionNotAllowed, post_transition
+
+logger = logging.getLogger(__name__)
 
 caroni_exchange = 'caroni_exchange'
 
@@ -36,6 +50,10 @@ agent_id = base64.urlsafe_b64encode(u.bytes).rstrip(b"=").decode()
 def get_agent_topic():
     return f"wf.agent.{agent_id}"
 
+def fulfillment_topic(job_type_name):
+    # Where JobFulfillmentRequests for a JobType are sent
+    return f"wf.agent.fulfillment.{job_type_name}"
+
 def sign_and_seal(msg):
     # Take an object ('msg') and put it in a CaroniEnvelope.  Return the CE
     any_payload = Any()
@@ -48,6 +66,29 @@ def sign_and_seal(msg):
 
     return ce
 
+def publish(routing_key, msg, correlation_id=None):
+    # correlation_id is whatever the manager gave us (its Workflow); echoing it
+    # back lets a sharded manager route the reply to the worker that owns it.
+    # From a handler, this goes once the handler's transaction commits.
+    transaction.on_commit(partial(
+        channel.basic_publish,
+        exchange=caroni_exchange,
+        properties=pika.BasicProperties(
+            reply_to=get_agent_topic(),
+            correlation_id=correlation_id or None,
+            delivery_mode=pika.DeliveryMode.Persistent),
+        routing_key=routing_key,
+        body=sign_and_seal(msg).SerializeToString()))
+
+# uuids of Jobs that are ready to run, oldest first
+ready_jobs = deque()
+
+@receiver(post_transition, sender=Job)
+def job_queued(sender, instance, target, **kwargs):
+    # Only once it's committed, or the main loop could beat it to the database
+    if target == "queued":
+        transaction.on_commit(partial(ready_jobs.append, instance.uuid))
+
 def enum_given_fsm(fsm_value):
     return JobStatus.Value("JOB_STATUS_" + fsm_value.upper())
 
@@ -64,11 +105,8 @@ def report_job_status(
         job_status=enum_given_fsm(job.state),
         status_info=status_info)
 
-    channel.basic_publish(
-        exchange=caroni_exchange,
-        properties=pika.BasicProperties(reply_to=get_agent_topic()),
-        routing_key=job.reply_to,
-        body=sign_and_seal(job_status_update).SerializeToString())
+    publish(job.reply_to, job_status_update,
+            correlation_id=job.correlation_id)
 
 def jfr_process(jfr, method=None, properties=None):
     # For now we decline or offer based purely on if we have an exactly name job
@@ -76,19 +114,18 @@ def jfr_process(jfr, method=None, properties=None):
     # and (statically sent) values, and even advanced conditions based on those
     # bits of info.  This will likely result in a plugin system or call backs.
 
-    job_found = False
-
-    job_types_with_name = JobType.objects.filter(name=jfr.job_type_name)
-    for job_type_with_name in job_types_with_name:
-        input_names = [_.name for _ in job_type_with_name.inputs.all()]
-        key_names = [_.key for _ in jfr.parameters]
+    job_found = job_type_index.match(
+        jfr.job_type_name, [_.key for _ in jfr.parameters]) is not None
 
-        if set(input_names) == set(key_names):
-            job_found = True
-            break
+    if job_found:
+        # Do we have room for it?
+        decline_message, estimated_start = admission.check()
+    else:
+        decline_message = f"No jobtype of {jfr.job_type_name}"
 
-    if(job_found):
-        expiration_seconds = int((datetime.now() + timedelta(hours=5)).timestamp())
+    if decline_message is None:
+        expiration_seconds = int((datetime.now() + timedelta(
+            seconds=settings.CARONI_AGENT_OFFER_TTL)).timestamp())
         epoch_obj = datetime.fromtimestamp(expiration_seconds, tz=timezone.utc)
 
         jo = JobOffer.objects.create(
@@ -101,35 +138,50 @@ def jfr_process(jfr, method=None, properties=None):
             offer_uuid=jo.uuid.bytes,
             site=Site(),
             offer_message=f"Offering for {jfr.job_type_name}",
-            expiration=Timestamp(seconds=expiration_seconds)
+            expiration=Timestamp(seconds=expiration_seconds),
+            estimated_start=Timestamp(
+                seconds=int(estimated_start.timestamp()))
             )
 
-        channel.basic_publish(
-            exchange=caroni_exchange,
-            properties=pika.BasicProperties(reply_to=get_agent_topic()),
-            routing_key=properties.reply_to,
-            body=sign_and_seal(jfo).SerializeToString())
+        publish(properties.reply_to, jfo,
+                correlation_id=properties.correlation_id)
         print(f"Sent JobFulfillmentOffer of {jo.uuid} to request {uuid.UUID(bytes=jfr.request_uuid)}")
     else:
         jfd = JobFulfillmentDecline(
             signature=Signature(),
             request_uuid=jfr.request_uuid,
             site=Site(),
-            decline_message=f"No jobtype of {jfr.job_type_name}")
+            decline_message=decline_message)
 
-        channel.basic_publish(
-            exchange=caroni_exchange,
-            properties=pika.BasicProperties(reply_to=get_agent_topic()),
-            routing_key=properties.reply_to,
-            body=sign_and_seal(jfd).SerializeToString())
-        print(f"Sent JobFulfillmentDecline to request {uuid.UUID(bytes=jfr.request_uuid)}")
+        publish(properties.reply_to, jfd,
+                correlation_id=properties.correlation_id)
+        print(f"Sent JobFulfillmentDecline to request {uuid.UUID(bytes=jfr.request_uuid)}: {decline_message}")
+
+def jfor_process(jfor, method=None, properties=None):
+    # The manager went with someone else; give back the place we held
+    JobOffer.objects.filter(uuid=uuid.UUID(bytes=jfor.offer_uuid)).delete()
+    print(f"Offer {uuid.UUID(bytes=jfor.offer_uuid)} rejected")
 
 def jfoa_process(jfoa, method=None, properties=None):
     # Move the offer to the job with the new ID
-    jo = JobOffer.objects.get(uuid=uuid.UUID(bytes=jfoa.offer_uuid))
+    offer_uuid = uuid.UUID(bytes=jfoa.offer_uuid)
+    jo = JobOffer.objects.filter(uuid=offer_uuid).first()
+    if jo is not None and jo.expires_at <= datetime.now(tz=timezone.utc):
+        # Expired, so its place may have gone to someone else; take it anyway
+        # if there's still room
+        reason, _ = admission.check()
+        if reason is not None:
+            jo.delete()
+            jo = None
+    if jo is None:
+        # Reaped, or no room for it now.  The manager hears nothing back, and
+        # asks for the step again after its CARONI_MANAGER_ACCEPT_TIMEOUT.
+        print(f"Offer {offer_uuid} accepted after it expired, not taking it")
+        return
     job_type = JobType.objects.get(name=jo.job_type_name)
     job = Job.objects.create(
         reply_to=properties.reply_to,
+        correlation_id=properties.correlation_id or "",
         job_type=job_type,
         state="pending")
     job.create_inputs_from_type()
@@ -141,13 +193,23 @@ def jfoa_process(jfoa, method=None, properties=None):
         job_uuid=job.uuid.bytes,
         offer_uuid=jfoa.offer_uuid)
 
-    channel.basic_publish(
-        exchange=caroni_exchange,
-        properties=pika.BasicProperties(reply_to=get_agent_topic()),
-        routing_key=properties.reply_to,
-        body=sign_and_seal(job_accepted).SerializeToString())
+    publish(properties.reply_to, job_accepted,
+            correlation_id=properties.correlation_id)
+
+    print(f"Sent JobAccepted of {job.uuid} to offer {offer_uuid}")
 
-    print(f"Sent JobAccepted of {job.uuid} to offer {uuid.UUID(bytes=jfoa.offer_uuid)}")
+def job_kill_process(job_kill, method=None, properties=None):
+    job = Job.objects.filter(uuid=uuid.UUID(bytes=job_kill.job_uuid)).first()
+    if job is None or job.state in ("completed", "failed"):
+        print(f"Nothing to kill for job {uuid.UUID(bytes=job_kill.job_uuid)}")
+        return
+
+    job.fail()
+    job.save()
+    # Frees the slot; the body's own finish_job() will find it failed
+    transaction.on_commit(partial(executor.cancel, job.uuid))
+    report_job_status(job, f"Killed: {job_kill.kill_info}")
+    print(f"Job {job.uuid} killed: {job_kill.kill_info}")
 
 def jsr_process(jsr, method=None, properties=None):
     job = Job.objects.get(uuid=uuid.UUID(bytes=jsr.job_uuid))
@@ -157,45 +219,45 @@ def jsr_process(jsr, method=None, properties=None):
         job_status=enum_given_fsm(job.state),
         status_info="This job is now in doing something different")
 
-    channel.basic_publish(
-        exchange=caroni_exchange,
-        properties=pika.BasicProperties(reply_to=get_agent_topic()),
-        routing_key=properties.reply_to,
-        body=sign_and_seal(job_status_update).SerializeToString())
+    publish(properties.reply_to, job_status_update,
+            correlation_id=properties.correlation_id)
 
 def jda_process(jda, method=None, properties=None):
     print(f"In JobDataAvailable!")
     job = Job.objects.get(uuid=uuid.UUID(bytes=jda.job_uuid))
+    if job.state == "failed":
+        return # Killed before it got going
 
-    for param in jda.parameters:
-        job.deliver_input(name=param.key, value=param.value)
+    job.deliver_inputs({param.key: param.value for param in jda.parameters})
 
     if job.state == "queued": # We've gotten all of our inputs
         report_job_status(job)
 
+callback_routes = {
+    JobFulfillmentRequest: jfr_process,
+    JobFulfillmentOfferAccept: jfoa_process,
+    JobFulfillmentOfferReject: jfor_process,
+    JobStatusRequest: jsr_process,
+    JobDataAvailable: jda_process,
+    JobKill: job_kill_process,
+}
+
+dispatcher = Dispatcher(callback_routes)
+
 def callback(ch, method, properties, body):
-    envelope = CaroniEnvelope()
-    envelope.ParseFromString(body)
-
-    any_payload = envelope.payload
-    if any_payload.Is(JobFulfillmentRequest.DESCRIPTOR):
-        jfr = JobFulfillmentRequest()
-        any_payload.Unpack(jfr)
-        jfr_process(jfr, method=method, properties=properties)
-    elif any_payload.Is(JobFulfillmentOfferAccept.DESCRIPTOR):
-        jfoa = JobFulfillmentOfferAccept()
-        any_payload.Unpack(jfoa)
-        jfoa_process(jfoa, method=method, properties=properties)
-    elif any_payload.Is(JobStatusRequest.DESCRIPTOR):
-        jsr = JobStatusRequest()
-        any_payload.Unpack(jsr)
-        jsr_process(jsr, method=method, properties=properties)
-    elif any_payload.Is(JobDataAvailable.DESCRIPTOR):
-        jda = JobDataAvailable()
-        any_payload.Unpack(jda)
-        jda_process(jda, method=method, properties=properties)
-    else:
-        print("Unknown routing key")
+    try:
+        with transaction.atomic():
+            dispatcher.dispatch(body, method=method, properties=properties)
+    except Exception:
+        # One more go, then drop it
+        requeue = not method.redelivered
+        logger.exception(
+            "Handler failed on %s, %s", method.routing_key,
+            "requeueing" if requeue else "dropping")
+        ch.basic_nack(method.delivery_tag, requeue=requeue)
+        return
+    # Committed, and (confirm mode) everything it sent is with the broker
+    ch.basic_ack(method.delivery_tag)
 
 
 
@@ -220,6 +282,8 @@ for attempt in range(1, 5):
 
 connection = pika.BlockingConnection(parameters)
 channel = connection.channel()
+channel.basic_qos(prefetch_count=settings.CARONI_AGENT_PREFETCH)
+channel.confirm_delivery()
 channel.exchange_declare(caroni_exchange, exchange_type="topic")
 
 declare_result = channel.queue_declare(queue="", exclusive=True)
@@ -232,78 +296,224 @@ channel.queue_bind(
     routing_key=get_agent_topic()
 )
 
-# Where open requests come in to
-channel.queue_bind(
-    exchange=caroni_exchange,
-    queue=agent_queue_name,
-    routing_key='wf.agent.fulfillment'
-)
+# Where open requests come in to, one per JobType we have; see
+# bind_job_types()
+bound_job_types = set()
 
 channel.basic_consume(
     queue=agent_queue_name,
-    auto_ack=True,
     on_message_callback=callback)
 
-print(' [*] Waiting for messages. To exit press CTRL+C')
-
-while True:
-    connection.process_data_events(time_limit=1.0)
+def start_job(job):
+    # Main thread: get a queued Job going in one of the executor's slots
+    job.run()
+    job.save()
 
-    # Get the first queued job if any
-    first_job = Job.objects.filter(state="queued").order_by("queued_at").first()
+    inputs = {}
+    for ji in JobInput.objects.filter(job=job):
+        inputs[ji.name] = ji.value
 
-    if first_job:
-        first_job.run()
-        first_job.save()
+    report_job_status(job)
 
-        new_env = {}
-        for ji in JobInput.objects.filter(job=first_job):
-            new_env["CARONI_ENV_" +ji.name] = ji.value
+    executor.submit(job.uuid, job.job_type, inputs)
 
-        report_job_status(first_job)
+def job_done(job_uuid, future):
+    # Pool thread: hand over to the main thread, waking it if need be
+    connection.add_callback_threadsafe(partial(finish_job, job_uuid, future))
 
-        result = subprocess.run(
-            ["bash", "-c", first_job.job_type.body],
-            capture_output=True,
-            text=True,
-            env=new_env
-        )
+def job_output(job_uuid, outputs):
+    # Pool thread, while the body is still running; see executors.py
+    connection.add_callback_threadsafe(partial(stream_outputs, job_uuid, outputs))
 
+def send_outputs(job, outputs):
+    """
+    Deliver {name: value} outputs of job, and tell the manager about the ones
+    that took.  Returns how many did.
+    """
+    parameters = []
+    for k, v in outputs.items():
         try:
-            job_outs = json.loads(result.stdout)
-        except Exception as e:
-            # We won't have any job_outs to compare to job.outputs (and
-            # ultimately send to manager). This doesn't obviate "the spec" from
-            # sending partial JobData while the job is running. More a comment
-            # on this "reference implementation".
-            first_job.fail()
-            first_job.save()
-            report_job_status(first_job, "Agent could not parse job results.")
-            print("JSON failed")
-            print(f"STDOUT is: {result.stdout}" )
-            print(f"STDERR is: {result.stderr}" )
+            job.deliver_output(name=k, value=v)
+        except (JobOutput.DoesNotExist, TransitionNotAllowed):
+            print(f"Job {job.uuid}: ignoring unknown or repeated output {k}")
             continue
+        parameters.append(JobParameter(key=k, value=v))
 
-        for k, v in job_outs.items():
-            first_job.deliver_output(name=k, value=v)
-
-        first_job.complete()
-        first_job.save()
-        report_job_status(first_job)
-
-        print(f"Job {first_job.uuid} finished!")
-
-        for output in first_job.outputs.all():
-            # Check here for output.available else fail?
-            jp = JobParameter(
-                key=output.name,
-                value=output.value)
-            jda = JobDataAvailable(
-                signature=Signature(),
-                job_uuid=first_job.uuid.bytes,
-                parameters=[jp]) # TODO could collect and then send
-            channel.basic_publish(
-                exchange=caroni_exchange,
-                properties=pika.BasicProperties(reply_to=get_agent_topic()),
-                routing_key=first_job.reply_to,
-                body=sign_and_seal(jda).SerializeToString())
+    if parameters:
+        jda = JobDataAvailable(
+            signature=Signature(),
+            job_uuid=job.uuid.bytes,
+            parameters=parameters)
+        publish(job.reply_to, jda, correlation_id=job.correlation_id)
+    return len(parameters)
+
+@transaction.atomic
+def stream_outputs(job_uuid, outputs):
+    # Main thread; the job's next step can start on these without waiting for
+    # the rest of it
+    job = Job.objects.get(uuid=job_uuid)
+    if job.state != "running":
+        return # Killed
+    sent = send_outputs(job, outputs)
+    print(f"Job {job.uuid} sent {sent} output(s) early")
+
+def fail_finished_job(job, status_info, result=None):
+    job.fail()
+    job.save()
+    report_job_status(job, status_info)
+    print(f"Job {job.uuid} failed: {status_info}")
+    if result is not None:
+        print(f"STDOUT ends: {result.stdout}" )
+        print(f"STDERR ends: {result.stderr}" )
+        print(f"Full logs in {result.stdout_path} and {result.stderr_path}")
+
+@transaction.atomic
+def finish_job(job_uuid, future):
+    # Main thread, once a job's body has finished
+    executor.finished(job_uuid)
+    job = Job.objects.get(uuid=job_uuid)
+    if job.state != "running":
+        return # Killed, and already reported as such
+
+    try:
+        result = future.result()
+    except Exception as e:
+        print(f"Job body could not be run: {e}")
+        fail_finished_job(job, "Agent could not run the job body.")
+        return
+
+    if result.returncode != 0:
+        fail_finished_job(
+            job, f"Job body exited with {result.returncode}.", result)
+        return
+
+    try:
+        # Bodies that didn't stream their outputs print them all at the end
+        if result.streamed:
+            job_outs = {}
+        elif result.stdout_complete:
+            job_outs = json.loads(result.stdout)
+        else:
+            raise ValueError("stdout too big to parse; use CARONI_OUTPUT_FD")
+    except Exception:
+        # We won't have any job_outs to compare to job.outputs (and
+        # ultimately send to manager).
+        print("JSON failed")
+        fail_finished_job(job, "Agent could not parse job results.", result)
+        return
+
+    send_outputs(job, job_outs)
+
+    # Whatever's waiting on an output the body never gave would wait forever
+    missing = list(job.outputs.exclude(state="available").values_list(
+        "name", flat=True))
+    if missing:
+        fail_finished_job(
+            job, f"Job body gave no {', '.join(missing)}.", result)
+        return
+
+    job.complete()
+    job.save()
+    report_job_status(job)
+
+    print(f"Job {job.uuid} finished!")
+
+if settings.CARONI_AGENT_EXECUTOR == "batch":
+    executor = BatchExecutor(
+        settings.CARONI_AGENT_BATCH_SLOTS,
+        job_done,
+        job_output,
+        batch_dir=settings.CARONI_AGENT_BATCH_DIR,
+        submit_command=settings.CARONI_AGENT_BATCH_SUBMIT,
+        status_command=settings.CARONI_AGENT_BATCH_STATUS,
+        cancel_command=settings.CARONI_AGENT_BATCH_CANCEL,
+        poll_interval=settings.CARONI_AGENT_BATCH_POLL,
+        tail_bytes=settings.CARONI_AGENT_LOG_TAIL_BYTES,
+        log_dir=settings.CARONI_AGENT_LOG_DIR,
+        log_keep_days=settings.CARONI_AGENT_LOG_KEEP_DAYS)
+else:
+    executor = LocalExecutor(
+        settings.CARONI_AGENT_SLOTS,
+        job_done,
+        job_output,
+        log_dir=settings.CARONI_AGENT_LOG_DIR,
+        log_max_bytes=settings.CARONI_AGENT_LOG_MAX_BYTES,
+        log_backups=settings.CARONI_AGENT_LOG_BACKUPS,
+        log_tail_bytes=settings.CARONI_AGENT_LOG_TAIL_BYTES,
+        log_keep_days=settings.CARONI_AGENT_LOG_KEEP_DAYS,
+        warm_max_jobs=settings.CARONI_AGENT_WARM_MAX_JOBS,
+        warm_max_rss_mb=settings.CARONI_AGENT_WARM_MAX_RSS_MB,
+        kill_grace=settings.CARONI_AGENT_KILL_GRACE)
+
+admission = AdmissionPolicy(
+    executor,
+    queue_depth=settings.CARONI_AGENT_QUEUE_DEPTH,
+    max_cpu_percent=settings.CARONI_AGENT_MAX_CPU_PERCENT,
+    min_free_memory_mb=settings.CARONI_AGENT_MIN_FREE_MEMORY_MB)
+
+def bind_job_types():
+    # Only hear requests we might be able to take
+    names = job_type_index.names()
+    for name in names - bound_job_types:
+        channel.queue_bind(
+            exchange=caroni_exchange,
+            queue=agent_queue_name,
+            routing_key=fulfillment_topic(name))
+    for name in bound_job_types - names:
+        channel.queue_unbind(
+            exchange=caroni_exchange,
+            queue=agent_queue_name,
+            routing_key=fulfillment_topic(name))
+    bound_job_types.clear()
+    bound_job_types.update(names)
+
+def reap_offers():
+    # Offers the manager never answered give their places back in time (see
+    # AdmissionPolicy); this clears them out of the table
+    reaped, _ = JobOffer.objects.filter(
+        expires_at__lte=datetime.now(tz=timezone.utc)).delete()
+    if reaped:
+        print(f"Reaped {reaped} expired offer(s)")
+    connection.call_later(settings.CARONI_AGENT_OFFER_REAP, reap_offers)
+
+def refresh_job_types():
+    # Pick up JobTypes changed by other processes (the admin)
+    job_type_index.rebuild()
+    bind_job_types()
+    executor.job_types_changed(job_type_index.job_types())
+    connection.call_later(
+        settings.CARONI_AGENT_JOB_TYPE_REFRESH, refresh_job_types)
+
+def prune_logs():
+    executor.prune_logs()
+    connection.call_later(settings.CARONI_AGENT_LOG_PRUNE, prune_logs)
+
+def log_stats():
+    print(f"Handled so far: {dispatcher.summary()}")
+    connection.call_later(settings.CARONI_AGENT_STATS_INTERVAL, log_stats)
+
+refresh_job_types()
+reap_offers()
+prune_logs()
+if settings.CARONI_AGENT_STATS_INTERVAL > 0:
+    connection.call_later(settings.CARONI_AGENT_STATS_INTERVAL, log_stats)
+
+# Anything queued before we (re)started is still ours to run
+ready_jobs.extend(Job.objects.filter(state="queued").order_by(
+    "queued_at").values_list("uuid", flat=True))
+
+print(f' [*] Waiting for messages ({executor.slots} job slots). To exit press CTRL+C')
+
+while True:
+    # With nothing we can start, sleep until a message comes in or a job
+    # finishes; either one that frees a slot or queues a job is dealt with
+    # by the time this returns.
+    can_start = ready_jobs and executor.free_slots()
+    connection.process_data_events(time_limit=0 if can_start else None)
+
+    while ready_jobs and executor.free_slots():
+        # Skip any that were failed (or run) since being queued
+        job = Job.objects.filter(
+            uuid=ready_jobs.popleft(), state="queued").first()
+        if job:
+            start_job(job)
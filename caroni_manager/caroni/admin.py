@@ -2,15 +2,27 @@ from django.contrib import admin
 
 from caroni.models import (
     Workflow, WorkflowTemplate, WorkflowStep, WorkflowDataflow, Job)
+from caroni.messaging import send_workflow_cancels
 
 
 @admin.register(Workflow)
 class WorkflowAdmin(admin.ModelAdmin):
-    pass
+    actions = ["cancel_workflows"]
+
+    @admin.action(description="Cancel selected workflows (and kill their jobs)")
+    def cancel_workflows(self, request, queryset):
+        # wf_server.py does the cancelling; see workflow_cancel()
+        live = queryset.exclude(state__in=["completed", "failed"])
+        workflow_uuids = list(live.values_list("uuid", flat=True))
+        send_workflow_cancels(
+            workflow_uuids, f"cancelled by {request.user.get_username()}")
+        self.message_user(
+            request, f"Asked the manager to cancel {len(workflow_uuids)} workflow(s)")
 
 @admin.register(WorkflowTemplate)
 class WorkflowTemplateAdmin(admin.ModelAdmin):
-    pass
+    # cwl_doc is compiled (and rejected if bad) by WorkflowTemplate.clean()
+    readonly_fields = ["plan_digest", "plan"]
 
 @admin.register(WorkflowStep)
 class WorkflowStepAdmin(admin.ModelAdmin):
@@ -0,0 +1,191 @@
+"""
+Everything that needs cwltool lives here.  A CWL document goes in, and a plain
+(JSON friendly) plan comes out; see compile_cwl().  Nothing downstream of the
+plan needs to know CWL exists.
+"""
+import textwrap
+from threading import Lock
+from urllib.parse import urljoin
+
+from cwltool.load_tool import load_tool
+from cwltool.workflow import default_make_tool # just needs to be imported?
+from cwltool.context import LoadingContext
+
+from schema_salad.fetcher import Fetcher
+
+from caroni.plan import TemplateCompileError
+
+
+class InMemoryFetcher(Fetcher):
+    def __init__(self, cache, session):
+        self.store = store
+
+    def supported_schemes(self):
+        return ["mem", "https", "http"]
+
+    def fetch_text(self, url, content_types=None, **kwargs):
+        if url.startswith("mem://"):
+            return self.store[url]
+        return super().fetch_text(url, **kwargs)
+
+    def check_exists(self, url):
+        if "caroni" in url:
+            return True
+        return url in self.store
+
+    def urljoin(self, base, ref):
+        return urljoin(base, ref)
+
+store = {
+    "records.yml": textwrap.dedent("""\
+        ---
+        $schema: https://json-schema.org/draft/2019-09/schema
+        $graph:
+          - name: Stage1Record
+              type: record
+              fields:
+              - name: input_text
+                  type: string
+
+          - name: Stage2Record
+              type: record
+              fields:
+              - name: processed_text
+                  type: string
+              - name: word_count
+                  type: int
+
+          - name: Stage3Record
+              type: record
+              fields:
+              - name: summary
+                  type: string
+              - name: score
+                  type: float
+""")
+}
+
+# store is shared by every load; one compile at a time
+compile_lock = Lock()
+
+def mem_resolver(loader, uri):
+    # Accept mem:// URIs as-is
+    return uri
+
+def uri_helper(uri):
+    """
+    Small helper to break URI in to parts.  Will likely need generalize and
+    pull out.
+    """
+    _, anchor = uri.split("#") # _ is base_uri
+    anchor_split = anchor.split("/")
+    # If there is no stepname, then we assume it's an input/output from the
+    # workflow itself.  Let the caller know.
+    if len(anchor_split) == 1:
+        from_workflow = True
+        step_name = "" # Workflow
+        ioput_name = anchor_split[0]
+    else:
+        from_workflow = False
+        step_name = anchor_split[0]
+        ioput_name = anchor_split[1]
+
+    return locals()
+
+def compile_step(step):
+    """
+    Takes a cwltool WorkflowStep and returns the plan entry for it
+    """
+    step_name = step.id.split("#")[1] # 0 is namespace
+
+    # We don't currently support static values, but this is where it would
+    # be if ever.  If never, a list makes more sense than a dict.
+    kvs = {}
+    inputs = step.tool['run'].get("inputs", [])
+    for an_input in inputs:
+        if an_input['type'] != "string":
+            raise TemplateCompileError(
+                f"Step {step_name}: only string inputs are supported")
+        kvs[an_input['id'].split('/')[-1]] = ""
+    hints = step.tool['run'].get("hints") or []
+    for hint in hints:
+        if 'CaroniJobName' in hint:
+            job_name = hint['CaroniJobName']
+            break
+    else:
+        raise TemplateCompileError(
+            f"Step {step_name}: CaroniRequirement not found")
+
+    return {"step_name": step_name, "job_name": job_name, "job_kvs": kvs}
+
+def compile_dataflows(step):
+    dataflows = []
+    for an_in in step.tool['in']:
+        this_step = uri_helper(an_in['id'])
+        source_step = uri_helper(an_in['source'])
+        # the step we're operating on won't ever have an input that is from
+        # the Workflow
+        dataflows.append({
+            "src_step": source_step["step_name"] or None,
+            "src_output": source_step["ioput_name"],
+            "dst_step": this_step["step_name"],
+            "dst_input": this_step["ioput_name"],
+        })
+    return dataflows
+
+def compile_outputs(outputs_ast):
+    outputs = []
+    for an_output in outputs_ast:
+        source_step = uri_helper(an_output['outputSource'])
+        wf_out = uri_helper(an_output['id'])
+        outputs.append({
+            "src_step": source_step["step_name"],
+            "src_output": source_step["ioput_name"],
+            "name": wf_out["ioput_name"],
+        })
+    return outputs
+
+def compile_cwl(cwl_doc):
+    """
+    Run cwltool over a CWL document and boil the result down to a plan:
+
+        {
+            "steps": [{"step_name", "job_name", "job_kvs"}, ...],
+            "dataflows": [{"src_step", "src_output", "dst_step", "dst_input"}, ...],
+            "outputs": [{"src_step", "src_output", "name"}, ...],
+        }
+
+    A "src_step" of None is the Workflow's own inputs.  Raises
+    TemplateCompileError if the document can't be turned into a plan.
+    """
+    with compile_lock:
+        store['mem://workflow.cwl'] = cwl_doc
+        ctx = LoadingContext()
+        ctx.fetcher_constructor = InMemoryFetcher
+        ctx.resolver = mem_resolver
+        ctx.construct_tool_object = default_make_tool
+        try:
+            workflow_ast = load_tool("mem://workflow.cwl", loadingContext=ctx)
+        except Exception as e:
+            raise TemplateCompileError(str(e)) from e
+
+    if not hasattr(workflow_ast, "steps"):
+        raise TemplateCompileError("CWL document is not a Workflow")
+
+    steps = [compile_step(step) for step in workflow_ast.steps]
+
+    # Go around again to get dataflows.  All the steps need to be known first
+    # (previous loop)
+    step_names = {step["step_name"] for step in steps}
+    dataflows = []
+    for step in workflow_ast.steps:
+        dataflows.extend(compile_dataflows(step))
+
+    # Turn any outputs into dataflows
+    outputs = compile_outputs(workflow_ast.tool['outputs'])
+
+    for df in dataflows + outputs:
+        if df["src_step"] is not None and df["src_step"] not in step_names:
+            raise TemplateCompileError(f"Unknown source step {df['src_step']}")
+
+    return {"steps": steps, "dataflows": dataflows, "outputs": outputs}
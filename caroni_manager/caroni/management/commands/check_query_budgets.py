@@ -0,0 +1,274 @@
+"""
+Checks that each of wf_server.py's message handlers makes no more than its
+budget of queries (query_budgets below), however big the Workflow.  Exits
+non-zero if any go over.
+
+    python manage.py check_query_budgets [--width 50]
+
+Messages are replayed through wf_server.handle(), as if from agents and
+sites, against a throwaway test database (as the test runner makes one, so
+PostgreSQL needs CREATEDB): the WorkflowTemplates in demo_data.json, then the
+whole life of a Workflow that fans out to --width steps, then one that is
+cancelled and one that fails.  A handler that starts following relations one
+row at a time shows up here, rather than in the handlers themselves.
+"""
+import contextlib
+import io
+import uuid
+from collections import defaultdict
+
+import pika
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+
+import wf_server
+from caroni.models import WorkflowStep, WorkflowTemplate
+from caroni.plan import cwl_digest
+from gen.workflow_messages_pb2 import (
+    CaroniEnvelope, JobAccepted, JobDataAvailable, JobFulfillmentDecline,
+    JobFulfillmentOffer, JobFulfillmentRequest, JobParameter, JobStatus,
+    JobStatusUpdate, WorkFlowCancel, WorkFlowCreate, WorkFlowInput)
+
+
+# The most queries each handler should make, however big the Workflow
+query_budgets = {
+    JobFulfillmentDecline: 0,
+    JobFulfillmentOffer: 6,
+    # Includes stopping the offer's deadline
+    JobAccepted: 11,
+    # The last failure of a step fails its Workflow too (fail_workflow())
+    JobStatusUpdate: 11,
+    # bulk_create() on SQLite batches big DAGs, so more there.  One more the
+    # first time a template without a current plan is used (fixtures), when
+    # plan_cache compiles it and saves the plan.
+    WorkFlowCreate: 12,
+    JobDataAvailable: 5,
+    WorkFlowCancel: 6,
+}
+
+class Recorder:
+    """ Stands in for wf_server's transport, keeping what was published """
+    def __init__(self):
+        self.sent = []
+
+    def publish_many(self, messages):
+        for routing_key, body, correlation_id in messages:
+            envelope = CaroniEnvelope()
+            envelope.ParseFromString(body)
+            self.sent.append((routing_key, envelope.payload, correlation_id))
+
+    def take_requests(self):
+        """ The JobFulfillmentRequests sent since last time """
+        requests = []
+        for routing_key, payload, correlation_id in self.sent:
+            if payload.Is(JobFulfillmentRequest.DESCRIPTOR):
+                jfr = JobFulfillmentRequest()
+                payload.Unpack(jfr)
+                requests.append((jfr, correlation_id))
+        self.sent.clear()
+        return requests
+
+class Replay:
+    def __init__(self):
+        self.transport = Recorder()
+        # Message type -> queries each time it was handled
+        self.counts = defaultdict(list)
+
+    def send(self, msg, handler, correlation_id=None):
+        properties = pika.BasicProperties(
+            reply_to="wf.agent.check_query_budgets",
+            correlation_id=correlation_id)
+        # connection.queries_log only holds so many, after which
+        # CaptureQueriesContext sees none
+        reset_queries()
+        # Handlers print() as they go
+        with CaptureQueriesContext(connection) as queries, \
+                contextlib.redirect_stdout(io.StringIO()):
+            wf_server.handle(
+                msg.DESCRIPTOR.full_name, msg, handler, properties=properties)
+        # handle()'s own BEGIN and COMMIT are logged too; they aren't the
+        # handler's
+        self.counts[type(msg)].append(sum(
+            1 for query in queries.captured_queries
+            if query["sql"] not in ("BEGIN", "COMMIT")))
+
+    def create(self, template_name):
+        self.send(
+            WorkFlowCreate(
+                template_name=template_name,
+                inputs=[WorkFlowInput(key="start", value="x")]),
+            wf_server.workflow_create)
+        return self.transport.take_requests()
+
+    def take(self, jfr, correlation_id):
+        """ Offer for a JobFulfillmentRequest, and start the job """
+        offer_uuid = uuid.uuid4().bytes
+        job_uuid = uuid.uuid4().bytes
+        self.send(
+            JobFulfillmentOffer(
+                request_uuid=jfr.request_uuid, offer_uuid=offer_uuid),
+            wf_server.jfr_offer_process, correlation_id)
+        # Another agent, too late
+        self.send(
+            JobFulfillmentOffer(
+                request_uuid=jfr.request_uuid, offer_uuid=uuid.uuid4().bytes),
+            wf_server.jfr_offer_process, correlation_id)
+        self.send(
+            JobAccepted(offer_uuid=offer_uuid, job_uuid=job_uuid),
+            wf_server.job_accepted_process, correlation_id)
+        for status in (JobStatus.JOB_STATUS_QUEUED,
+                       JobStatus.JOB_STATUS_RUNNING):
+            self.status(job_uuid, status)
+        return job_uuid
+
+    def status(self, job_uuid, status, status_info=""):
+        self.send(
+            JobStatusUpdate(
+                job_uuid=job_uuid, job_status=status,
+                status_info=status_info),
+            wf_server.job_status_update_process)
+
+    def finish(self, job_uuid):
+        self.send(
+            JobDataAvailable(
+                job_uuid=job_uuid,
+                parameters=[JobParameter(key="out", value="v")]),
+            wf_server.job_data_available_process)
+        self.status(job_uuid, JobStatus.JOB_STATUS_COMPLETED)
+
+    def step_jobs(self, workflow_uuid):
+        steps = WorkflowStep.objects.filter(
+            workflow_id=workflow_uuid).select_related("current_job")
+        return {
+            step.step_name: step.current_job.uuid.bytes
+            for step in steps if step.current_job
+        }
+
+def fan_out_template(width):
+    """ s0 feeds s1..s<width - 1>, each of which is an output """
+    steps = [
+        {"step_name": f"s{i}", "job_name": "check_query_budgets",
+         "job_kvs": {"in": ""}}
+        for i in range(width)
+    ]
+    dataflows = [
+        {"src_step": None, "src_output": "start", "dst_step": "s0",
+         "dst_input": "in"}
+    ] + [
+        {"src_step": "s0", "src_output": "out", "dst_step": f"s{i}",
+         "dst_input": "in"}
+        for i in range(1, width)
+    ]
+    outputs = [
+        {"src_step": f"s{i}", "src_output": "out", "name": f"o{i}"}
+        for i in range(1, width)
+    ]
+    cwl_doc = f"# check_query_budgets fan out of {width}"
+    return WorkflowTemplate.objects.create(
+        name=f"check_query_budgets_{width}", cwl_doc=cwl_doc,
+        plan={"steps": steps, "dataflows": dataflows, "outputs": outputs},
+        plan_digest=cwl_digest(cwl_doc))
+
+def replay_fixtures(replay):
+    # First use compiles the template, the second finds its plan
+    for template in WorkflowTemplate.objects.all():
+        replay.create(template.name)
+        replay.create(template.name)
+
+def replay_workflow(replay, template):
+    """ A Workflow from start to end, with a failed job along the way """
+    requests = replay.create(template.name)
+    replay.send(
+        JobFulfillmentDecline(request_uuid=uuid.uuid4().bytes),
+        wf_server.jfr_decline_process)
+    for jfr, correlation_id in requests:
+        replay.take(jfr, correlation_id)
+    # Each request's correlation_id is its Workflow
+    jobs = replay.step_jobs(correlation_id)
+
+    # s1 fails and is asked for again
+    replay.status(jobs["s1"], JobStatus.JOB_STATUS_FAILED, "check")
+    replay.finish(jobs["s0"])
+    for jfr, correlation_id in replay.transport.take_requests():
+        jobs["s1"] = replay.take(jfr, correlation_id)
+
+    for step_name, job_uuid in jobs.items():
+        if step_name != "s0":
+            replay.finish(job_uuid)
+
+def replay_ending(replay, template, ending):
+    """ A Workflow, all of whose jobs are running, is cancelled or fails """
+    for jfr, correlation_id in replay.create(template.name):
+        replay.take(jfr, correlation_id)
+    workflow_uuid = uuid.UUID(correlation_id)
+    jobs = replay.step_jobs(workflow_uuid)
+
+    if ending == "cancel":
+        replay.send(
+            WorkFlowCancel(workflow_uuid=workflow_uuid.bytes, reason="check"),
+            wf_server.workflow_cancel, str(workflow_uuid))
+    else:
+        WorkflowStep.objects.filter(
+            workflow_id=workflow_uuid, step_name="s0").update(max_attempts=1)
+        replay.status(jobs["s0"], JobStatus.JOB_STATUS_FAILED, "check")
+    # Agents report their jobs killed
+    for job_uuid in jobs.values():
+        replay.status(job_uuid, JobStatus.JOB_STATUS_FAILED, "Killed")
+
+class Command(BaseCommand):
+    help = "Check wf_server.py's handlers keep to their query budgets"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--width", type=int, default=50,
+            help="Steps in the Workflows replayed (default 50).  On SQLite, "
+                 "WorkFlowCreate needs more queries somewhere past 100")
+
+    def handle(self, *args, **options):
+        if options["width"] < 2:
+            raise CommandError("--width needs to be at least 2")
+
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        try:
+            counts = self.replay(options["width"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        over = []
+        for msg_type, budget in query_budgets.items():
+            name = msg_type.DESCRIPTOR.name
+            handled = counts.get(msg_type)
+            if not handled:
+                over.append(name)
+                self.stdout.write(self.style.ERROR(f"{name}: never handled"))
+            elif max(handled) > budget:
+                over.append(name)
+                self.stdout.write(self.style.ERROR(
+                    f"{name}: {max(handled)} queries, budget is {budget}"))
+            else:
+                self.stdout.write(
+                    f"{name}: {min(handled)} to {max(handled)} queries, "
+                    f"budget is {budget}")
+
+        if over:
+            raise CommandError(f"{len(over)} handlers over budget")
+
+    def replay(self, width):
+        replay = Replay()
+        wf_server.transport = replay.transport
+        wf_server.manager_identity = wf_server.ManagerIdentity.load()
+
+        call_command(
+            "loaddata", settings.BASE_DIR / "demo_data.json", verbosity=0)
+        replay_fixtures(replay)
+
+        template = fan_out_template(width)
+        replay_workflow(replay, template)
+        replay_ending(replay, template, "cancel")
+        replay_ending(replay, template, "fail")
+        return replay.counts
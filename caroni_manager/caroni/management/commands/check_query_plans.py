@@ -0,0 +1,85 @@
+"""
+Checks that the manager's hot queries are planned with indexes, not table
+scans, so they hold up as the tables grow.  Exits non-zero if any aren't.
+
+    python manage.py check_query_plans
+
+Works against SQLite and PostgreSQL.  PostgreSQL is told to avoid sequential
+scans (enable_seqscan off) for the check, as it would rightly pick them for
+small tables anyway; one that still shows up has no index to use instead.
+"""
+import re
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from caroni.models import (
+    JobOffer, JobRequest, WorkflowDataflow, WorkflowStep)
+
+
+def hot_queries():
+    # The values don't matter, only the shape of the query
+    some_uuid = uuid.uuid4()
+    return {
+        "dataflows from a step (job_data_available_process)":
+            WorkflowDataflow.objects.filter(wfstep_src_id=1).select_related(
+                "wfstep_dst__current_job"),
+        "dataflows to a step (job_accepted_process retransmits)":
+            WorkflowDataflow.objects.filter(
+                wfstep_dst_id=1, state="delivered"),
+        "Workflow inputs awaiting (job_accepted_process)":
+            WorkflowDataflow.objects.filter(
+                workflow_id=some_uuid, wfstep_src=None,
+                state="awaiting").select_related("wfstep_dst__current_job"),
+        "step by name":
+            WorkflowStep.objects.filter(
+                workflow_id=some_uuid, step_name="a_step"),
+        "step by job":
+            WorkflowStep.objects.filter(current_job_id=some_uuid),
+        "JobRequests by state":
+            JobRequest.objects.filter(state="fulfilling"),
+        "JobOffers by state":
+            JobOffer.objects.filter(state="received"),
+        "JobRequests waiting on agents (wf_server.restore_timers)":
+            JobRequest.objects.filter(
+                state="fulfilling", deadline__isnull=False),
+        "JobOffers waiting on JobAccepted (wf_server.restore_timers)":
+            JobOffer.objects.filter(deadline__isnull=False),
+    }
+
+def table_scans(plan):
+    """ The tables a query plan reads from start to end """
+    if connection.vendor == "postgresql":
+        return re.findall(r"Seq Scan on (\w+)", plan)
+    # SQLite: "SCAN t" is a table scan, "SCAN t USING INDEX i" isn't
+    return [
+        match.group(1) for match in re.finditer(r"\bSCAN (\w+)(.*)", plan)
+        if "USING" not in match.group(2)
+    ]
+
+class Command(BaseCommand):
+    help = "Check the manager's hot queries use indexes"
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ("postgresql", "sqlite"):
+            raise CommandError(f"Don't know how to read {connection.vendor} plans")
+
+        failed = []
+        with transaction.atomic():
+            if connection.vendor == "postgresql":
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+
+            for name, queryset in hot_queries().items():
+                plan = queryset.explain()
+                scans = table_scans(plan)
+                if scans:
+                    failed.append(name)
+                    self.stdout.write(self.style.ERROR(
+                        f"{name}: scans {', '.join(scans)}\n{plan}"))
+                else:
+                    self.stdout.write(f"{name}: ok")
+
+        if failed:
+            raise CommandError(f"{len(failed)} hot queries scan tables")
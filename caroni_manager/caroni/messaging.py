@@ -0,0 +1,62 @@
+"""
+Sending messages to our manager from outside of wf_server.py (the admin's
+cancel action, for one).  Opens a connection per call; nothing here is hot.
+"""
+import base64
+import os
+
+import pika
+
+from google.protobuf.any_pb2 import Any
+
+from gen.workflow_messages_pb2 import CaroniEnvelope, Signature, WorkFlowCancel
+
+from caroni.models import WorkflowSite
+
+
+caroni_exchange = "caroni_exchange"
+
+def amqp_parameters():
+    if 'AMQP_URL' in os.environ:
+        amqp_url = os.environ["AMQP_URL"]
+        print(f"AMQP_URL is {amqp_url}")
+        return pika.URLParameters(amqp_url)
+
+    credentials = pika.PlainCredentials('username', 'password')
+    return pika.ConnectionParameters(
+        'localhost',
+        5672,
+        '/',
+        credentials)
+
+def manager_topic():
+    # wf_server.py creates the WorkflowSite when it first starts
+    this_site = WorkflowSite.objects.get()
+    manager_id = base64.urlsafe_b64encode(
+        this_site.uuid.bytes).rstrip(b"=").decode()
+    return f"wf.manager.{manager_id}"
+
+def send_workflow_cancels(workflow_uuids, reason):
+    """ Ask the manager to cancel each of the Workflows """
+    topic = manager_topic()
+    connection = pika.BlockingConnection(amqp_parameters())
+    try:
+        channel = connection.channel()
+        channel.confirm_delivery()
+        for workflow_uuid in workflow_uuids:
+            wf_cancel = WorkFlowCancel(
+                signature=Signature(),
+                workflow_uuid=workflow_uuid.bytes,
+                reason=reason)
+            any_payload = Any()
+            any_payload.Pack(wf_cancel)
+            envelope = CaroniEnvelope(signature=Signature(), payload=any_payload)
+            channel.basic_publish(
+                exchange=caroni_exchange,
+                routing_key=topic,
+                body=envelope.SerializeToString(),
+                properties=pika.BasicProperties(
+                    correlation_id=str(workflow_uuid),
+                    delivery_mode=pika.DeliveryMode.Persistent))
+    finally:
+        connection.close()
@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-18 13:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caroni', '0004_workflowdataflow_value'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflowtemplate',
+            name='plan',
+            field=models.JSONField(default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='workflowtemplate',
+            name='plan_digest',
+            field=models.CharField(default='', editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 6.0 on 2026-10-18 13:30
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_steps(apps, schema_editor):
+    Workflow = apps.get_model("caroni", "Workflow")
+    WorkflowStep = apps.get_model("caroni", "WorkflowStep")
+    counts = WorkflowStep.objects.values("workflow_id", "state").annotate(
+        n=Count("id"))
+    for row in counts:
+        Workflow.objects.filter(pk=row["workflow_id"]).update(
+            **{f"steps_{row['state']}": row["n"]})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caroni', '0005_workflowtemplate_plan'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflow',
+            name='steps_completed',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='steps_created',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='steps_failed',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='steps_fulfilled',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='steps_fulfilling',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='steps_running',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_steps, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caroni', '0006_workflow_step_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='joboffer',
+            index=models.Index(fields=['state'], name='joboffer_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='jobrequest',
+            index=models.Index(fields=['state'], name='jobrequest_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='workflowdataflow',
+            index=models.Index(fields=['wfstep_dst', 'state'], name='wfdf_dst_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='workflowdataflow',
+            index=models.Index(fields=['workflow', 'wfstep_src', 'state'], name='wfdf_wf_src_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='workflowstep',
+            index=models.Index(fields=['workflow', 'step_name'], name='wfstep_workflow_name_idx'),
+        ),
+    ]
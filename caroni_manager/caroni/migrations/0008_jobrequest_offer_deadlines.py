@@ -0,0 +1,32 @@
+# Generated by Django 6.0 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caroni', '0007_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='joboffer',
+            name='deadline',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='jobrequest',
+            name='broadcasts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='jobrequest',
+            name='deadline',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='joboffer',
+            index=models.Index(condition=models.Q(('deadline__isnull', False)), fields=['deadline'], name='joboffer_deadline_idx'),
+        ),
+    ]
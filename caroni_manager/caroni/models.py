@@ -1,7 +1,13 @@
 import uuid
 
-from django.db import models
-from django_fsm import FSMField, transition
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Count, F
+from django.dispatch import receiver
+from django_fsm import (
+    FSMField, transition, ConcurrentTransitionMixin, post_transition)
+
+from caroni.plan import cwl_digest, TemplateCompileError
 
 
 class WorkflowSite(models.Model):
@@ -15,17 +21,58 @@ class WorkflowTemplate(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4)
     name = models.CharField(max_length=255, default="")
     cwl_doc = models.TextField()
+    # The compiled cwl_doc (see caroni.cwl.compile_cwl()), and the digest of
+    # the cwl_doc it was compiled from.
+    plan = models.JSONField(default=dict, editable=False)
+    plan_digest = models.CharField(max_length=64, default="", editable=False)
+
+    def compile(self):
+        """
+        Compile cwl_doc into plan.  This is the only place cwltool gets pulled
+        in for a template; workflows are built from the plan.
+        """
+        from caroni.cwl import compile_cwl
+        self.plan = compile_cwl(self.cwl_doc)
+        self.plan_digest = cwl_digest(self.cwl_doc)
+
+    def plan_is_current(self):
+        return bool(self.plan_digest) and \
+            self.plan_digest == cwl_digest(self.cwl_doc)
+
+    def clean(self):
+        # Reject bad templates at upload (admin) time, not WorkFlowCreate time
+        try:
+            self.compile()
+        except TemplateCompileError as e:
+            raise ValidationError({"cwl_doc": str(e)})
 
     def __str__(self):
         return f"{self.name} - {self.uuid}"
 
-class Workflow(models.Model):
+# The states a WorkflowStep can be in, each counted on its Workflow
+STEP_STATES = [
+    "created", "fulfilling", "fulfilled", "running", "completed", "failed"]
+STEP_COUNT_FIELDS = [f"steps_{state}" for state in STEP_STATES]
+
+# The FSM models below refuse to save (ConcurrentTransition) if another
+# manager worker moved their state since they were loaded; wf_server.handle()
+# rolls back and runs the handler again.
+class Workflow(ConcurrentTransitionMixin, models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4)
     template = models.ForeignKey(WorkflowTemplate, on_delete=models.CASCADE)
     cwl_doc = models.TextField()
     state = FSMField(default="created", protected=True)
     workflow_inputs = models.JSONField(default=dict)
     workflow_outputs = models.JSONField(default=dict)
+    # How many of our steps are in each state, so the check_*() below don't
+    # have to look at every step.  Kept by count_step_transition(), and only
+    # ever written with F() updates; see save().
+    steps_created = models.IntegerField(default=0, editable=False)
+    steps_fulfilling = models.IntegerField(default=0, editable=False)
+    steps_fulfilled = models.IntegerField(default=0, editable=False)
+    steps_running = models.IntegerField(default=0, editable=False)
+    steps_completed = models.IntegerField(default=0, editable=False)
+    steps_failed = models.IntegerField(default=0, editable=False)
 
     # created, initalizing, running, stalled, failed, completed
     @transition(field=state, source="created", target="initalizing")
@@ -54,118 +101,99 @@ class Workflow(models.Model):
     def fail(self):
         pass
 
-    def add_step(self, step_name, step, kvs=None):
-        """
-        Takes a cwltool WorkflowStep and adds a WorkflowStep to this Workflow
+    def instantiate(self, plan, request_deadline=None):
         """
-        if kvs is None:
-            kvs = {}
-
-        # We don't currently support static values, but this is where it would
-        # be if ever.  If never, a list makes more sense than a dict.
-        inputs = step.tool['run'].get("inputs", [])
-        for an_input in inputs:
-            if an_input['type'] != "string":
-                raise Exception()
-            kvs[an_input['id'].split('/')[-1]] = ""
-        hints = step.tool['run'].get("hints", [])
-        for hint in hints:
-            if 'CaroniJobName' in hint:
-                job_name = hint['CaroniJobName']
-                break
-        else:
-            raise Exception("CaroniRequirement not found")
-
-        # Add to Workflow
-        WorkflowStep.objects.create(
-            workflow=self, job_name=job_name, step_name=step_name, job_kvs=kvs
-        )
+        Build this Workflow's steps and dataflows from a plan (see
+        caroni.cwl.compile_cwl()), and a first JobRequest for each step, due
+        to be answered by request_deadline.  The JobRequests are returned,
+        ready for their JobFulfillmentRequests to be sent.
 
-    def uri_helper(self, uri):
+        Everything is bulk inserted in one transaction, so the number of
+        queries doesn't grow with the size of the DAG.
         """
-        Small helper to break URI in to parts.  Will likely need generalize and
-        pull out.
-        """
-        _, anchor = uri.split("#") # _ is base_uri
-        anchor_split = anchor.split("/")
-        # If there is no stepname, then we assume it's an input/output from the
-        # workflow itself.  Let the caller know.
-        if len(anchor_split) == 1:
-            from_workflow = True
-            step_name = "" # Workflow
-            ioput_name = anchor_split[0]
-        else:
-            from_workflow = False
-            step_name = anchor_split[0]
-            ioput_name = anchor_split[1] 
-
-        return locals()
-
-    def process_dataflows(self, step_name, step):
-        ins = step.tool['in']
-        #Create WorkflowDataflow objects from the ins
-        
-        # 2) Consider how we'll inform of data-ready from $previous_job.  Do we
-        # even need to, or just assume that is out of band?
-        for an_in in ins:
-            this_step = self.uri_helper(an_in['id'])
-            source_step = self.uri_helper(an_in['source']) 
-            # the step we're operating on won't ever have an input that is from
-            # the Workflow
-            this_wfstep = WorkflowStep.objects.get(
-                workflow=self,
-                step_name=this_step["step_name"])
-            
-            if not source_step["from_workflow"]:
-                source_wfstep = WorkflowStep.objects.get(
+        with transaction.atomic():
+            steps = []
+            for plan_step in plan["steps"]:
+                step = WorkflowStep(
                     workflow=self,
-                    step_name=source_step["step_name"])
-            else:
-                source_wfstep=None
-
-            WorkflowDataflow.objects.create(
-                workflow=self,
-                src_output_name=source_step['ioput_name'],
-                dst_input_name=this_step['ioput_name'],
-                wfstep_src=source_wfstep,
-                wfstep_dst=this_wfstep)
-
-    def process_outputs(self, outputs_ast):
-        for an_output in outputs_ast:
-            source_step = self.uri_helper(an_output['outputSource'])
-            wf_out = self.uri_helper(an_output['id'])
-            source_wfstep = WorkflowStep.objects.get(
-                workflow=self,
-                step_name=source_step["step_name"])
-            WorkflowDataflow.objects.create(
-                workflow=self,
-                src_output_name=source_step['ioput_name'],
-                dst_input_name=wf_out['ioput_name'],
-                wfstep_src=source_wfstep,
-                wfstep_dst=None)
+                    job_name=plan_step["job_name"],
+                    step_name=plan_step["step_name"],
+                    # We don't currently support static values, but this is
+                    # where they'd be if ever.
+                    job_kvs=dict(plan_step["job_kvs"]))
+                step.fulfill()
+                steps.append(step)
+            WorkflowStep.objects.bulk_create(steps)
+            # bulk_create() doesn't go through count_step_transition()
+            self.steps_fulfilling = len(steps)
+            self.save(update_fields=["steps_fulfilling"])
+            steps_by_name = {step.step_name: step for step in steps}
+
+            # A src_step of None is an input from the Workflow itself, and a
+            # Workflow output has no dst step.
+            dataflows = []
+            for df in plan["dataflows"]:
+                dataflows.append(WorkflowDataflow(
+                    workflow=self,
+                    src_output_name=df["src_output"],
+                    dst_input_name=df["dst_input"],
+                    wfstep_src=steps_by_name.get(df["src_step"]),
+                    wfstep_dst=steps_by_name[df["dst_step"]]))
+            for an_output in plan["outputs"]:
+                dataflows.append(WorkflowDataflow(
+                    workflow=self,
+                    src_output_name=an_output["src_output"],
+                    dst_input_name=an_output["name"],
+                    wfstep_src=steps_by_name[an_output["src_step"]],
+                    wfstep_dst=None))
+            WorkflowDataflow.objects.bulk_create(dataflows)
+
+            job_requests = []
+            for step in steps:
+                jr = JobRequest(workflow_step=step, deadline=request_deadline)
+                jr.fulfill()
+                job_requests.append(jr)
+            JobRequest.objects.bulk_create(job_requests)
+
+        return job_requests
+
+    def save(self, *args, **kwargs):
+        # Leave the step counts alone unless asked; what we loaded may be
+        # behind the F() updates made since.
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in STEP_COUNT_FIELDS]
+        super().save(*args, **kwargs)
+
+    def step_counts(self):
+        """
+        {state: number of steps in it}, fresh from the database
+        """
+        # Not refresh_from_db(), which trips over the protected state field
+        counts = Workflow.objects.filter(pk=self.pk).values(
+            *STEP_COUNT_FIELDS).get()
+        for field, count in counts.items():
+            setattr(self, field, count)
+        return {state: counts[f"steps_{state}"] for state in STEP_STATES}
+
+    def all_steps_in(self, states):
+        counts = self.step_counts()
+        return sum(counts[state] for state in states) == sum(counts.values())
 
     def clear_to_send_dataflows(self):
         """ We only want to send dataflows when all Steps are fulfilled (or
         better).  This could be an internal state, but I didn't think it made
         sense to muddy up the FSM. """
-        cts = True
-        for step in self.workflow_steps.all():
-            if step.state not in ["running", "fulfilled", "completed"]:
-                cts  = False
-                break
-        return cts
+        return self.all_steps_in(["running", "fulfilled", "completed"])
 
     # TODO Generalize this function to update a WF from the state of it's Steps
     def check_complete(self):
         """
         If all steps are complete, complete the Workflow
         """
-        complete = True
-        for step in self.workflow_steps.all():
-            if step.state != "completed":
-                complete  = False
-                break
-        if complete:
+        if self.all_steps_in(["completed"]):
             self.complete()
             self.save()
 
@@ -175,16 +203,28 @@ class Workflow(models.Model):
         If the Workflow is stalled, all steps have left stalled ("fulfilled",
         "running", "completed"), we can go back to "running"
         """
-        recovered = True
         if self.state == "stalled":
-            for wf in self.workflow_steps.all():
-                if wf.state not in ["fulfilled","running", "completed"]:
-                    recovered = False
-                    break
-            if recovered:
+            if self.all_steps_in(["fulfilled", "running", "completed"]):
                 self.run()
                 self.save()
 
+    def fail_steps(self):
+        """
+        Fail every step that isn't already over, for a failed Workflow.  One
+        update for all of them; a bulk update doesn't go through
+        count_step_transition(), so the counts are moved here.
+        """
+        live = ["created", "fulfilling", "fulfilled", "running"]
+        steps = WorkflowStep.objects.filter(workflow=self, state__in=live)
+        counts = dict(steps.values_list("state").annotate(n=Count("pk")))
+        if not counts:
+            return
+        steps.update(state="failed")
+        moved = {
+            f"steps_{state}": F(f"steps_{state}") - n
+            for state, n in counts.items()}
+        Workflow.objects.filter(pk=self.pk).update(
+            steps_failed=F("steps_failed") + sum(counts.values()), **moved)
 
     def __str__(self):
         return f"{self.uuid} - {self.state}"
@@ -196,7 +236,7 @@ class Workflow(models.Model):
 #
 # [0] I'm pedantic about ForeignKey(Foo) vs ForeignKey("Foo"); I'm seen some
 # stuff....
-class Job(models.Model):
+class Job(ConcurrentTransitionMixin, models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4)
     state = FSMField(default="pending", protected=True)
     reply_to = models.CharField(max_length=255, default="")
@@ -223,7 +263,7 @@ class Job(models.Model):
         return f"{self.uuid} - {self.state}"
 
 
-class WorkflowStep(models.Model):
+class WorkflowStep(ConcurrentTransitionMixin, models.Model):
     workflow = models.ForeignKey(
         Workflow, on_delete=models.CASCADE, related_name="workflow_steps")
     current_job = models.OneToOneField(
@@ -235,6 +275,13 @@ class WorkflowStep(models.Model):
     attempts = models.IntegerField(default=0)
     max_attempts = models.IntegerField(default=5)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["workflow", "step_name"],
+                name="wfstep_workflow_name_idx"),
+        ]
+
     def can_fulfill_again(self):
         return self.attempts < self.max_attempts - 1
 
@@ -279,7 +326,7 @@ class WorkflowStep(models.Model):
     def __str__(self):
         return f"Workflow - {self.workflow.uuid} - {self.job_name} - {self.state}"
 
-class WorkflowDataflow(models.Model):
+class WorkflowDataflow(ConcurrentTransitionMixin, models.Model):
     workflow = models.ForeignKey(Workflow, on_delete=models.CASCADE)
     state = FSMField(default="awaiting", protected=True)
     src_output_name = models.CharField(max_length=255, default="")
@@ -296,6 +343,19 @@ class WorkflowDataflow(models.Model):
         null=True, # null = wf output
         related_name="dst_dataflows")
 
+    # wfstep_src alone is covered by its ForeignKey index
+    class Meta:
+        indexes = [
+            # Retransmits to a refulfilled step
+            models.Index(
+                fields=["wfstep_dst", "state"],
+                name="wfdf_dst_state_idx"),
+            # The Workflow's own inputs (wfstep_src=None) still awaiting
+            models.Index(
+                fields=["workflow", "wfstep_src", "state"],
+                name="wfdf_wf_src_state_idx"),
+        ]
+
     # Can be delivered more than once, if Job is refulfilled
     @transition(field=state,
         source=["awaiting", "delivered"],
@@ -303,8 +363,19 @@ class WorkflowDataflow(models.Model):
     def deliver(self, value=None):
         if value:
             self.value=value
-            self.save()
 
+    @classmethod
+    def deliver_many(cls, deliveries):
+        """
+        Takes [(WorkflowDataflow, value)], delivers each, and writes them all
+        with one query.  bulk_update() skips ConcurrentTransitionMixin's check;
+        callers hold the Workflow's row (wf_server.lock_workflow()) instead.
+        """
+        dataflows = []
+        for df, value in deliveries:
+            df.deliver(value=value)
+            dataflows.append(df)
+        cls.objects.bulk_update(dataflows, ["state", "value"])
 
     def __str__(self):
         if self.wfstep_dst:
@@ -319,14 +390,22 @@ class WorkflowDataflow(models.Model):
 
         return f"WfDf {src_stepname}:{self.src_output_name} -> {dst_stepname}:{self.dst_input_name}: {self.state}"
 
-
-class JobRequest(models.Model):
+class JobRequest(ConcurrentTransitionMixin, models.Model):
     workflow_step = models.ForeignKey(
         WorkflowStep,
         on_delete=models.CASCADE,
         related_name="job_requests")
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4)
     state = FSMField(default="created", protected=True)
+    # While fulfilling: when to send it again (or give up, see
+    # wf_server.request_deadline()), and how many times it's been sent again
+    deadline = models.DateTimeField(null=True, blank=True)
+    broadcasts = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["state"], name="jobrequest_state_idx"),
+        ]
 
     # fulfilling, unanswered, fulfilled, refulfilling, expired?
     @transition(field=state, source="created", target="fulfilling")
@@ -355,17 +434,46 @@ class JobRequest(models.Model):
     def expire(self):
         pass
 
-class JobOffer(models.Model):
+class JobOffer(ConcurrentTransitionMixin, models.Model):
     job_request = models.ForeignKey(JobRequest, on_delete=models.CASCADE)
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4)
     state = FSMField(default="received", protected=True)
-    # TODO Need to track expiration here, and likely another state (expired)
-
-    # received, accepted, declined
+    # Accepted offers: when we stop waiting for the agent's JobAccepted (see
+    # wf_server.offer_deadline()).  Cleared once it comes.
+    deadline = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["state"], name="joboffer_state_idx"),
+            # Only the few offers still waiting on a JobAccepted
+            models.Index(
+                fields=["deadline"], name="joboffer_deadline_idx",
+                condition=models.Q(deadline__isnull=False)),
+        ]
+
+    # received, accepted, rejected, expired
     @transition(field=state, source="received", target="accepted")
     def accept(self):
         pass
 
     @transition(field=state, source="received", target="rejected")
     def reject(self):
-        pass
\ No newline at end of file
+        pass
+
+    @transition(field=state, source="accepted", target="expired")
+    def expire(self):
+        self.deadline = None
+
+@receiver(post_transition, sender=WorkflowStep)
+def count_step_transition(sender, instance, source, target, **kwargs):
+    """
+    Move the step from one count to the other on its Workflow.  This is in the
+    handler's transaction, so it goes (or not) with the step's own save().
+    """
+    # Steps not saved yet are counted by whoever saves them (instantiate())
+    if instance.pk is None or source == target:
+        return
+    Workflow.objects.filter(pk=instance.workflow_id).update(**{
+        f"steps_{source}": F(f"steps_{source}") - 1,
+        f"steps_{target}": F(f"steps_{target}") + 1,
+    })
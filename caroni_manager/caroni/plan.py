@@ -0,0 +1,66 @@
+"""
+Compiled WorkflowTemplate plans.  Plans are compiled when a template is saved
+(see WorkflowTemplate.clean()) and stored on it; wf_server.py keeps the ones it
+uses in memory here.  See caroni.cwl.compile_cwl() for the shape of a plan.
+
+Nothing here imports cwltool.
+"""
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+
+
+class TemplateCompileError(Exception):
+    pass
+
+def cwl_digest(cwl_doc):
+    return hashlib.sha256(cwl_doc.encode()).hexdigest()
+
+class PlanCache:
+    """
+    Bounded LRU of plans keyed by the digest of the CWL document.  Keying on
+    the document (and not the template) means an edited template is simply a
+    miss; its old entry ages out on its own.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.plans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, template):
+        """
+        Return the plan for a WorkflowTemplate, from memory if we can, else
+        from the plan stored on the template.  Raises TemplateCompileError for
+        a bad template.
+        """
+        digest = cwl_digest(template.cwl_doc)
+        with self.lock:
+            plan = self.plans.get(digest)
+            if plan is not None:
+                self.plans.move_to_end(digest)
+                self.hits += 1
+                return plan
+            self.misses += 1
+
+        if not template.plan_is_current():
+            # Templates saved through the admin are compiled already; this is
+            # for those that weren't (fixtures, or from before plans existed).
+            # Compile once and keep it.
+            template.compile()
+            template.save(update_fields=["plan", "plan_digest"])
+        self.put(digest, template.plan)
+
+        return template.plan
+
+    def put(self, digest, plan):
+        with self.lock:
+            self.plans[digest] = plan
+            self.plans.move_to_end(digest)
+            while len(self.plans) > self.maxsize:
+                self.plans.popitem(last=False)
+
+plan_cache = PlanCache(maxsize=settings.CARONI_PLAN_CACHE_SIZE)
@@ -132,3 +132,49 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
 
 STATIC_URL = 'static/'
+
+
+# Caroni
+# Knobs for wf_server.py; each can be overridden from the environment.
+
+# How many compiled WorkflowTemplate plans wf_server.py keeps in memory
+CARONI_PLAN_CACHE_SIZE = int(os.environ.get("CARONI_PLAN_CACHE_SIZE", 128))
+
+# "blocking" handles one message at a time on a pika BlockingConnection.
+# "asyncio" (wf_server_async.py) handles messages for different Workflows
+# concurrently, with the handlers run on a pool of CARONI_MANAGER_THREADS.
+CARONI_MANAGER_MODE = os.environ.get("CARONI_MANAGER_MODE", "blocking")
+CARONI_MANAGER_THREADS = int(os.environ.get("CARONI_MANAGER_THREADS", 8))
+
+# How the manager's queues are laid out; see wf_server.ManagerTopology.  0 is a
+# single manager.  With more than one shard, this process is worker
+# CARONI_MANAGER_WORKER_INDEX (from 0) of CARONI_MANAGER_WORKERS.
+CARONI_MANAGER_SHARDS = int(os.environ.get("CARONI_MANAGER_SHARDS", 0))
+CARONI_MANAGER_WORKERS = int(os.environ.get("CARONI_MANAGER_WORKERS", 1))
+CARONI_MANAGER_WORKER_INDEX = int(
+    os.environ.get("CARONI_MANAGER_WORKER_INDEX", 0))
+# Times a handler is run when it keeps losing races with other workers
+CARONI_MANAGER_RETRIES = int(os.environ.get("CARONI_MANAGER_RETRIES", 5))
+
+# Messages the broker hands us before we've acked the earlier ones
+CARONI_MANAGER_PREFETCH = int(os.environ.get("CARONI_MANAGER_PREFETCH", 32))
+
+# Print what's been handled (Dispatcher.summary()) this often, in seconds; 0
+# never does
+CARONI_MANAGER_STATS_INTERVAL = float(
+    os.environ.get("CARONI_MANAGER_STATS_INTERVAL", 300))
+
+# A JobRequest no agent has taken is sent again after
+# CARONI_MANAGER_REQUEST_TIMEOUT seconds, then after twice that, and so on,
+# CARONI_MANAGER_REQUEST_REBROADCASTS times before its step (and Workflow) is
+# failed.  An accepted offer whose agent hasn't sent JobAccepted within
+# CARONI_MANAGER_ACCEPT_TIMEOUT seconds is dropped and the step asked for again.
+# Deadlines are checked every CARONI_MANAGER_TIMER_TICK seconds.
+CARONI_MANAGER_REQUEST_TIMEOUT = float(
+    os.environ.get("CARONI_MANAGER_REQUEST_TIMEOUT", 10))
+CARONI_MANAGER_REQUEST_REBROADCASTS = int(
+    os.environ.get("CARONI_MANAGER_REQUEST_REBROADCASTS", 4))
+CARONI_MANAGER_ACCEPT_TIMEOUT = float(
+    os.environ.get("CARONI_MANAGER_ACCEPT_TIMEOUT", 30))
+CARONI_MANAGER_TIMER_TICK = float(
+    os.environ.get("CARONI_MANAGER_TIMER_TICK", 1))
@@ -0,0 +1,97 @@
+"""
+Routes CaroniEnvelope payloads to their handlers.  Shared by wf_server.py and
+wf_agent.py; keep the two copies identical (much like gen/).
+"""
+import logging
+from collections import Counter
+from threading import Lock
+from time import monotonic
+
+from gen.workflow_messages_pb2 import CaroniEnvelope
+
+
+logger = logging.getLogger(__name__)
+
+class Dispatcher:
+    """
+    Takes routes of {message class: handler} and dispatches on the payload's
+    type_url with a single dict lookup, rather than trying Any.Is() on each
+    type in turn.
+
+    Every message goes through dispatch(), which makes this the place to count
+    and time things.
+    """
+    def __init__(self, routes):
+        # "type.googleapis.com/caroni.JobAccepted" -> "caroni.JobAccepted"
+        self.routes = {
+            msg_type.DESCRIPTOR.full_name: (msg_type, handler)
+            for msg_type, handler in routes.items()
+        }
+        self.handled = Counter()
+        self.unknown = Counter()
+        self.seconds = Counter()
+        # Handlers may be run from more than one thread (wf_server_async.py)
+        self.lock = Lock()
+
+    def unpack(self, body, method=None):
+        """
+        Open the envelope.  Returns (type_name, msg, handler), where msg and
+        handler are None if we don't know the type.
+        """
+        envelope = CaroniEnvelope()
+        envelope.ParseFromString(body)
+
+        any_payload = envelope.payload
+        type_name = any_payload.type_url.rpartition("/")[2]
+        try:
+            msg_type, handler = self.routes[type_name]
+        except KeyError:
+            with self.lock:
+                self.unknown[type_name] += 1
+                seen = self.unknown[type_name]
+            logger.warning(
+                "Unknown message type %r on routing key %s (%d seen)",
+                type_name, getattr(method, "routing_key", None), seen)
+            return type_name, None, None
+
+        msg = msg_type()
+        msg.ParseFromString(any_payload.value)
+
+        return type_name, msg, handler
+
+    def handle(self, type_name, msg, handler, method=None, properties=None):
+        start = monotonic()
+        try:
+            handler(msg, method=method, properties=properties)
+        finally:
+            with self.lock:
+                self.handled[type_name] += 1
+                self.seconds[type_name] += monotonic() - start
+
+    def dispatch(self, body, method=None, properties=None):
+        type_name, msg, handler = self.unpack(body, method=method)
+        if handler is not None:
+            self.handle(
+                type_name, msg, handler, method=method, properties=properties)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "handled": dict(self.handled),
+                "unknown": dict(self.unknown),
+                "seconds": dict(self.seconds),
+            }
+
+    def summary(self):
+        """
+        stats() on one line for the log: how many of each type were handled,
+        and how long their handler took on average.
+        """
+        stats = self.stats()
+        parts = [
+            f"{type_name} {n} ({stats['seconds'][type_name] / n * 1000:.1f}ms)"
+            for type_name, n in sorted(stats["handled"].items())]
+        parts += [
+            f"{type_name} {n} unknown"
+            for type_name, n in sorted(stats["unknown"].items())]
+        return ", ".join(parts) or "nothing yet"
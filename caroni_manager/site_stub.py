@@ -109,9 +109,14 @@ wf_create = WorkFlowCreate(
     wf_name="test_workflow",
     inputs=[wf_input])
 
+# A sharded manager (CARONI_MANAGER_SHARDS) hashes on correlation_id, so give
+# the new Workflow one of its own
 channel.basic_publish(
     exchange=caroni_exchange,
-    properties=pika.BasicProperties(reply_to=get_agent_topic()),
+    properties=pika.BasicProperties(
+        reply_to=get_agent_topic(),
+        correlation_id=str(uuid.uuid4()),
+        delivery_mode=pika.DeliveryMode.Persistent),
     routing_key=get_dest_manager_topic(),
     body=sign_and_seal(wf_create).SerializeToString())
 
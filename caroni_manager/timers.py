@@ -0,0 +1,44 @@
+"""
+The manager's deadlines: JobRequests no agent has taken, and accepted offers
+whose agent never sent JobAccepted.
+
+The deadlines themselves live in the database (JobRequest.deadline,
+JobOffer.deadline).  Timers is a heap of them in memory, filled from the
+database at startup and added to as handlers commit, which wf_server.py's
+runtimes check every CARONI_MANAGER_TIMER_TICK seconds.  A timer firing is
+only a cue to look; the handler it runs checks the deadline again under the
+Workflow's lock, so stale or duplicate timers (several manager workers, say)
+do nothing.
+"""
+import heapq
+from itertools import count
+from threading import Lock
+
+from django.utils import timezone
+
+
+class Timers:
+    def __init__(self):
+        # (when, tie breaker, kind, key, workflow uuid)
+        self.heap = []
+        self.order = count()
+        # Added to from handler threads (wf_server_async.py)
+        self.lock = Lock()
+
+    def add(self, when, kind, key, workflow_uuid):
+        with self.lock:
+            heapq.heappush(
+                self.heap, (when, next(self.order), kind, key, workflow_uuid))
+
+    def due(self, now=None):
+        """ Take the timers that are up, as [(kind, key, workflow uuid)] """
+        now = now or timezone.now()
+        fired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, _, kind, key, workflow_uuid = heapq.heappop(self.heap)
+                fired.append((kind, key, workflow_uuid))
+        return fired
+
+    def __len__(self):
+        return len(self.heap)
@@ -3,25 +3,27 @@
 import os
 import uuid
 import base64
-import textwrap
-from time import sleep
-from urllib.parse import urljoin
+import logging
+import signal
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
+from functools import partial
+from time import monotonic, sleep
 
 import pika
 
 from google.protobuf.any_pb2 import Any
 
-from cwltool.load_tool import load_tool
-from cwltool.workflow import default_make_tool # just needs to be imported?
-from cwltool.context import LoadingContext
-
-from schema_salad.fetcher import Fetcher
-
+from dispatch import Dispatcher
+from timers import Timers
 from gen.workflow_messages_pb2 import (
     JobStatus, JobFulfillmentRequest, Signature, JobParameter,
     JobFulfillmentDecline, JobFulfillmentOffer, JobFulfillmentOfferAccept,
     JobFulfillmentOfferReject, CaroniEnvelope, JobAccepted, JobStatusUpdate,
-    JobStatusRequest, WorkFlowCreate, JobDataAvailable)
+    JobStatusRequest, WorkFlowCreate, JobDataAvailable, JobKill,
+    WorkFlowCancel)
 
 
 # django melding magic; look away human
@@ -33,102 +35,276 @@ django.setup()
 from caroni.models import (
     Workflow, WorkflowTemplate, WorkflowStep, Job, JobRequest, JobOffer,
     WorkflowDataflow, WorkflowSite)
+from caroni.messaging import amqp_parameters, caroni_exchange
+from caroni.plan import plan_cache, TemplateCompileError
 
+from django.conf import settings
 from django.db import transaction
-from django_fsm import TransitionNotAllowed
-
-
-class InMemoryFetcher(Fetcher):
-    def __init__(self, cache, session):
-        self.store = store
-
-    def supported_schemes(self):
-        return ["mem", "https", "http"]
-
-    def fetch_text(self, url, content_types=None, **kwargs):
-        if url.startswith("mem://"):
-            return self.store[url]
-        return super().fetch_text(url, **kwargs)
-
-    def check_exists(self, url):
-        if "caroni" in url:
-            return True
-        return url in self.store
-
-    def urljoin(self, base, ref):
-        return urljoin(base, ref)
-
-store = {
-    "records.yml": textwrap.dedent("""\
-        ---
-        $schema: https://json-schema.org/draft/2019-09/schema
-        $graph:
-          - name: Stage1Record
-              type: record
-              fields:
-              - name: input_text
-                  type: string
-
-          - name: Stage2Record
-              type: record
-              fields:
-              - name: processed_text
-                  type: string
-              - name: word_count
-                  type: int
-
-          - name: Stage3Record
-              type: record
-              fields:
-              - name: summary
-                  type: string
-              - name: score
-                  type: float
-""")
-}
+from django.utils import timezone
+from django_fsm import TransitionNotAllowed, ConcurrentTransition
 
-def mem_resolver(loader, uri):
-    # Accept mem:// URIs as-is
-    return uri
-
-caroni_exchange = "caroni_exchange"
-
-if 'AMQP_URL' in os.environ:
-    amqp_url = os.environ["AMQP_URL"]
-    print(f"AMQP_URL is {amqp_url}")
-    parameters = pika.URLParameters(amqp_url)
-else:
-    credentials = pika.PlainCredentials('username', 'password')
-    parameters = pika.ConnectionParameters(
-        'localhost',
-        5672,
-        '/',
-        credentials)
-
-for attempt in range(1, 5):
-    try:
-        connection = pika.BlockingConnection(parameters)
-    except pika.exceptions.AMQPConnectionError:
-        print(f"RabbitMQ not ready (attempt {attempt}/5")
-        sleep(2)
 
-channel = connection.channel()
-channel.exchange_declare(caroni_exchange, exchange_type="topic")
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class ManagerIdentity:
+    """
+    Who this manager is, resolved from the WorkflowSite once at startup (and
+    again on SIGHUP) rather than on every publish.
+    """
+    site_uuid: uuid.UUID
+    manager_id: str
+    topic: str
+
+    @classmethod
+    def load(cls):
+        site_count = WorkflowSite.objects.count()
+        if site_count == 0:
+            this_site = WorkflowSite.objects.create()
+        elif site_count == 1:
+            this_site = WorkflowSite.objects.all().first()
+        else:
+            raise RuntimeError(
+                "More than one WorkflowSite found; This is unsupported.")
+
+        manager_id = base64.urlsafe_b64encode(
+            this_site.uuid.bytes).rstrip(b"=").decode()
+
+        return cls(
+            site_uuid=this_site.uuid,
+            manager_id=manager_id,
+            topic=f"wf.manager.{manager_id}")
+
+# Both set in main(); see the runtime (blocking here, or wf_server_async.py)
+manager_identity = None
+transport = None
+timers = Timers()
+
+def fulfillment_topic(job_type_name):
+    # Where JobFulfillmentRequests for a JobType are sent; see wf_agent.py
+    return f"wf.agent.fulfillment.{job_type_name}"
 
 def get_manager_topic():
-    site_count = WorkflowSite.objects.count()
-    if site_count == 0:
-        this_site = WorkflowSite.objects.create()
-    elif site_count == 1:
-        this_site = WorkflowSite.objects.all().first()
-    else:
-        raise RuntimeError(
-            "More than one WorkflowSite found; This is unsupported.")
+    return manager_identity.topic
+
+def reload_manager_identity():
+    """
+    Re-resolve the manager identity, moving our queue binding over if the
+    topic changed.  Runs on the connection's thread; see the SIGHUP handler.
+    """
+    global manager_identity
+    old_identity = manager_identity
+    manager_identity = ManagerIdentity.load()
+    print(f"Reloaded manager identity, topic: {manager_identity.topic}")
+
+    if manager_identity.topic != old_identity.topic:
+        transport.rebind(old_identity.topic, manager_identity.topic)
 
-    manager_id = base64.urlsafe_b64encode(
-        this_site.uuid.bytes).rstrip(b"=").decode()
+class ManagerTopology:
+    """
+    The queues (and exchanges) a manager consumes from, as a list of channel
+    calls so that the blocking and asyncio runtimes declare the same thing.
+    CARONI_MANAGER_SHARDS picks the layout:
 
-    return f"wf.manager.{manager_id}"
+    0: One exclusive queue, so one manager process per WorkflowSite.
+
+    1: One durable queue named for the topic, shared by any number of manager
+       processes as competing consumers.
+
+    N: A consistent hash exchange (the rabbitmq_consistent_hash_exchange
+       plugin) spreading messages over N durable queues by correlation_id,
+       which is the Workflow uuid.  All of a Workflow's messages land in the
+       same queue, in order.  Worker i of CARONI_MANAGER_WORKERS consumes the
+       shards where shard % workers == i.  Shards are single active consumer,
+       so workers that overlap take turns rather than racing.
+    """
+    def __init__(self, topic):
+        shards = settings.CARONI_MANAGER_SHARDS
+        workers = settings.CARONI_MANAGER_WORKERS
+        index = settings.CARONI_MANAGER_WORKER_INDEX
+
+        self.declarations = []
+        if shards == 0:
+            queue = f"{topic}.{uuid.uuid4().hex}"
+            self.declarations.append(
+                ("queue_declare", {"queue": queue, "exclusive": True}))
+            self.entry = ("queue", queue)
+            self.queues = [queue]
+        elif shards == 1:
+            self.declarations.append(
+                ("queue_declare", {"queue": topic, "durable": True}))
+            self.entry = ("queue", topic)
+            self.queues = [topic]
+        else:
+            hash_exchange = f"{topic}.hash"
+            self.declarations.append(("exchange_declare", {
+                "exchange": hash_exchange,
+                "exchange_type": "x-consistent-hash",
+                "durable": True,
+                "arguments": {"hash-property": "correlation_id"}}))
+            for shard in range(shards):
+                queue = f"{topic}.{shard}"
+                self.declarations.append(("queue_declare", {
+                    "queue": queue,
+                    "durable": True,
+                    "arguments": {"x-single-active-consumer": True}}))
+                # The routing key is the shard's weight
+                self.declarations.append(("queue_bind", {
+                    "queue": queue,
+                    "exchange": hash_exchange,
+                    "routing_key": "1"}))
+            self.entry = ("exchange", hash_exchange)
+            self.queues = [
+                f"{topic}.{shard}"
+                for shard in range(shards) if shard % workers == index]
+
+        self.declarations.append(self.bind_call(topic))
+
+    def bind_call(self, topic):
+        kind, name = self.entry
+        if kind == "queue":
+            return ("queue_bind", {
+                "queue": name, "exchange": caroni_exchange,
+                "routing_key": topic})
+        return ("exchange_bind", {
+            "destination": name, "source": caroni_exchange,
+            "routing_key": topic})
+
+    def unbind_call(self, topic):
+        method, kwargs = self.bind_call(topic)
+        return (method.replace("_bind", "_unbind"), kwargs)
+
+class BlockingTransport:
+    """
+    Sends messages for the handlers on a pika BlockingChannel.  Everything
+    happens on the one thread.  The channel is in confirm mode, so publish()
+    returns once the broker has the message (and raises if it won't take it).
+    """
+    def __init__(self, channel, topology):
+        self.channel = channel
+        self.topology = topology
+
+    def publish(self, routing_key, body, correlation_id=None):
+        self.channel.basic_publish(
+            exchange=caroni_exchange,
+            properties=pika.BasicProperties(
+                reply_to=get_manager_topic(),
+                correlation_id=correlation_id),
+            routing_key=routing_key,
+            body=body)
+
+    def publish_many(self, messages):
+        start = monotonic()
+        for routing_key, body, correlation_id in messages:
+            self.publish(routing_key, body, correlation_id=correlation_id)
+        # Each publish waited on its confirm
+        outbound.confirmed(monotonic() - start)
+
+    def rebind(self, old_topic, new_topic):
+        for method, kwargs in (self.topology.bind_call(new_topic),
+                               self.topology.unbind_call(old_topic)):
+            getattr(self.channel, method)(**kwargs)
+
+class OutboundBuffer:
+    """
+    Holds what a handler publish()es until its transaction has committed, then
+    hands the lot to the transport at once, grouped by routing key (in the
+    order they were published within each key).  A handler that fails or is
+    retried sends nothing.  See handle().
+
+    Buffers are per thread, as handlers may run on several (wf_server_async.py).
+    publish() outside of a handler sends straight away.
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.flushes = 0
+        self.messages = 0
+        self.largest = 0
+        # Flushes the broker has confirmed all of, and how long that took from
+        # flush() (as timed by the transport)
+        self.confirms = 0
+        self.seconds = 0.0
+
+    @contextmanager
+    def collect(self):
+        self.local.pending = {}
+        try:
+            yield
+        except BaseException:
+            self.local.pending = None
+            raise
+        pending, self.local.pending = self.local.pending, None
+        self.flush(pending)
+
+    def add(self, routing_key, body, correlation_id=None):
+        pending = getattr(self.local, "pending", None)
+        if pending is None:
+            self.flush({routing_key: [(body, correlation_id)]})
+        else:
+            pending.setdefault(routing_key, []).append((body, correlation_id))
+
+    def flush(self, pending):
+        messages = [
+            (routing_key, body, correlation_id)
+            for routing_key, bodies in pending.items()
+            for body, correlation_id in bodies
+        ]
+        if not messages:
+            return
+
+        transport.publish_many(messages)
+
+        with self.lock:
+            self.flushes += 1
+            self.messages += len(messages)
+            self.largest = max(self.largest, len(messages))
+        logger.debug(
+            "Flushed %d message(s) for %d routing key(s)",
+            len(messages), len(pending))
+
+    def confirmed(self, seconds):
+        # From the transport: a flush took this long to be confirmed
+        with self.lock:
+            self.confirms += 1
+            self.seconds += seconds
+
+    def stats(self):
+        with self.lock:
+            return {
+                "flushes": self.flushes,
+                "messages": self.messages,
+                "largest": self.largest,
+                "confirms": self.confirms,
+                "seconds": self.seconds,
+            }
+
+    def summary(self):
+        """ stats() on one line for the log """
+        stats = self.stats()
+        confirm_ms = stats["seconds"] / max(stats["confirms"], 1) * 1000
+        return (
+            f"{stats['messages']} message(s) in {stats['flushes']} flush(es), "
+            f"largest {stats['largest']}, {confirm_ms:.1f}ms to confirm")
+
+outbound = OutboundBuffer()
+
+def publish(routing_key, msg, correlation_id=None):
+    """
+    Seal msg and send it, once the handler's transaction commits (see
+    OutboundBuffer).
+
+    correlation_id is the Workflow uuid.  Agents echo it back so that their
+    replies can be kept in order (see ManagerTopology).
+    """
+    outbound.add(
+        routing_key, sign_and_seal(msg).SerializeToString(),
+        correlation_id=correlation_id)
+
+def lock_workflow(workflow_id):
+    # Other manager workers may be handling other steps of this Workflow; hold
+    # its row for the rest of the handler's transaction.
+    return Workflow.objects.select_for_update().get(pk=workflow_id)
 
 ### Split in to common TODO
 def sign_and_seal(msg):
@@ -163,25 +339,25 @@ def workflow_kvs_to_proto_parameters(kvs=None):
 
     return ret
 
-def send_job_data_available(
-    jp_key=None, jp_value=None, job_uuid=None, job_routing_key=None):
-    # TODO could make a multi-send version as JobDataAvailable takes parameters as a
-    # list.
-    jp = JobParameter(
-        key=jp_key,
-        value=jp_value)
-    jda = JobDataAvailable(
-        signature=Signature(),
-        job_uuid=job_uuid,
-        parameters=[jp])
-    channel.basic_publish(
-        exchange=caroni_exchange,
-        properties=pika.BasicProperties(reply_to=get_manager_topic()),
-        routing_key=job_routing_key,
-        body=sign_and_seal(jda).SerializeToString())
+def send_job_data_available(outgoing, workflow_uuid=None):
+    """
+    Takes a list of (Job, key, value).  Each destination Job (and routing key)
+    gets one JobDataAvailable with all of its parameters.
+    """
+    by_job = {}
+    for job, jp_key, jp_value in outgoing:
+        by_job.setdefault((job.uuid.bytes, job.reply_to), []).append(
+            JobParameter(key=jp_key, value=jp_value))
+
+    for (job_uuid, job_routing_key), parameters in by_job.items():
+        jda = JobDataAvailable(
+            signature=Signature(),
+            job_uuid=job_uuid,
+            parameters=parameters)
+        publish(job_routing_key, jda, correlation_id=workflow_uuid)
 
 def jfr_decline_process(jfd, method=None, properties=None):
-    # TODO This should not kill the JFR, but maybe it has a max_declines?
+    # Nothing to do; a request nobody takes times out (request_deadline())
     print(f" [x] Received JobFulfillmentDecline for : {uuid.UUID(bytes=jfd.request_uuid)}")
 
 def jfr_offer_process(jfo, method=None, properties=None):
@@ -191,8 +367,9 @@ def jfr_offer_process(jfo, method=None, properties=None):
     # Have we already fulfilled?
     accept = False
     with transaction.atomic():
-        jr = JobRequest.objects.get(uuid=uuid.UUID(bytes=jfo.request_uuid))
-        if jr.state == "fulfilling":
+        jr = JobRequest.objects.select_related("workflow_step").get(
+            uuid=uuid.UUID(bytes=jfo.request_uuid))
+        if jr.state == "fulfilling" and jr.workflow_step.state != "failed":
             # Accept
             jr.mark_fulfilled()
             jr.save()
@@ -205,17 +382,18 @@ def jfr_offer_process(jfo, method=None, properties=None):
         job_request=jr)
     if(accept):
         jo.accept()
+        # Until the agent's JobAccepted comes; see offer_deadline()
+        jo.deadline = timezone.now() + timedelta(
+            seconds=settings.CARONI_MANAGER_ACCEPT_TIMEOUT)
+        schedule("offer", jo.uuid, jo.deadline, jr.workflow_step.workflow_id)
         jfoa = JobFulfillmentOfferAccept(
             signature=Signature(),
             request_uuid=jfo.request_uuid,
             offer_uuid=jfo.offer_uuid,
             accept_message="offer accepted")
 
-        channel.basic_publish(
-            exchange=caroni_exchange,
-            properties=pika.BasicProperties(reply_to=get_manager_topic()),
-            routing_key=properties.reply_to,
-            body=sign_and_seal(jfoa).SerializeToString())
+        publish(properties.reply_to, jfoa,
+                correlation_id=properties.correlation_id)
 
         print(f"Sent JobFulfillmentOfferAccept to request {uuid.UUID(bytes=jfo.request_uuid)}")
     else: # Reject
@@ -226,11 +404,8 @@ def jfr_offer_process(jfo, method=None, properties=None):
             offer_uuid=jfo.offer_uuid,
             reject_message="offer rejected")
 
-        channel.basic_publish(
-            exchange=caroni_exchange,
-            properties=pika.BasicProperties(reply_to=get_manager_topic()),
-            routing_key=properties.reply_to,
-            body=sign_and_seal(jfor).SerializeToString())
+        publish(properties.reply_to, jfor,
+                correlation_id=properties.correlation_id)
 
         print(f"Sent JobFulfillmentOfferReject to request {uuid.UUID(bytes=jfo.request_uuid)}")
     jo.save()
@@ -239,28 +414,39 @@ def jfr_offer_process(jfo, method=None, properties=None):
 def job_accepted_process(job_accepted, method=None, properties=None):
     print(f" [x] Received JobAccepted for : {uuid.UUID(bytes=job_accepted.job_uuid)}")
 
-    jo = JobOffer.objects.get(uuid=uuid.UUID(bytes=job_accepted.offer_uuid))
+    jo = JobOffer.objects.select_related("job_request__workflow_step").get(
+        uuid=uuid.UUID(bytes=job_accepted.offer_uuid))
     wf_step = jo.job_request.workflow_step
+    wf = lock_workflow(wf_step.workflow_id)
+    # Stop its deadline, unless it's already past and we've moved on
+    if not JobOffer.objects.filter(pk=jo.pk, state="accepted").update(
+            deadline=None):
+        print(f"Offer {jo.uuid} has expired, the job isn't wanted")
+        job = Job(
+            uuid=uuid.UUID(bytes=job_accepted.job_uuid),
+            reply_to=properties.reply_to)
+        send_job_kill(job, f"Offer {jo.uuid} expired", str(wf.uuid))
+        return
     job = Job.objects.create(
         uuid=uuid.UUID(bytes=job_accepted.job_uuid),
         reply_to=properties.reply_to)
+    if wf.state == "failed":
+        # Offered and accepted before the Workflow went down
+        send_job_kill(job, f"Workflow {wf.uuid} has failed", str(wf.uuid))
+        return
     wf_step.current_job = job
     wf_step.mark_fulfilled()
     wf_step.save()
-    wf_step.workflow.check_recover_stalled()
+    wf.check_recover_stalled()
 
     # should this be scheduled for later?
     jsr = JobStatusRequest(
         signature=Signature(),
         job_uuid=job_accepted.job_uuid)
 
-    channel.basic_publish(
-        exchange=caroni_exchange,
-        properties=pika.BasicProperties(reply_to=get_manager_topic()),
-        routing_key=properties.reply_to,
-        body=sign_and_seal(jsr).SerializeToString())
+    publish(properties.reply_to, jsr, correlation_id=str(wf.uuid))
 
-    if wf_step.workflow.clear_to_send_dataflows():
+    if wf.clear_to_send_dataflows():
         # We should be on the last job being accepted. The Workflow as a whole
         # should be good to go; send Dataflow messages.
         #
@@ -272,35 +458,28 @@ def job_accepted_process(job_accepted, method=None, properties=None):
         # again. I'd rather make this logic a bit more concrete, but I'm waiting
         # for cases to reveal themselves.
         wf_dfs = WorkflowDataflow.objects.filter(
-            workflow=wf_step.workflow, wfstep_src=None, state="awaiting")
+            workflow=wf, wfstep_src=None, state="awaiting").select_related(
+                "wfstep_dst__current_job")
+        outgoing = []
+        deliveries = []
         for df in wf_dfs:
 
             jp_key = df.dst_input_name
-            jp_value = wf_step.workflow.workflow_inputs[df.src_output_name]
-            job_uuid = df.wfstep_dst.current_job.uuid.bytes
-            job_routing_key = df.wfstep_dst.current_job.reply_to
-
-            send_job_data_available(
-                jp_key=jp_key, jp_value=jp_value, job_uuid=job_uuid,
-                job_routing_key=job_routing_key)
+            jp_value = wf.workflow_inputs[df.src_output_name]
+            outgoing.append((df.wfstep_dst.current_job, jp_key, jp_value))
+            deliveries.append((df, jp_value))
 
-            df.deliver(value=jp_value)
-            df.save()
+        WorkflowDataflow.deliver_many(deliveries)
+        send_job_data_available(outgoing, workflow_uuid=str(wf.uuid))
 
     # Retransmit any DFs previously delivered for this Workflow (if the
     # following filter() returns anything, this new job is almost assuredly a
     # retry for a failed job)
     wf_dfs = WorkflowDataflow.objects.filter(
         wfstep_dst=wf_step, state="delivered")
-    for df in wf_dfs:
-        jp_key = df.dst_input_name
-        jp_value = df.value
-        job_uuid = df.wfstep_dst.current_job.uuid.bytes
-        job_routing_key = df.wfstep_dst.current_job.reply_to
-
-        send_job_data_available(
-            jp_key=jp_key, jp_value=jp_value, job_uuid=job_uuid,
-            job_routing_key=job_routing_key)
+    send_job_data_available(
+        [(job, df.dst_input_name, df.value) for df in wf_dfs],
+        workflow_uuid=str(wf.uuid))
 
 def job_status_update_process(job_status_update, method=None, properties=None):
     print(f" [x] Received JobStatusUpdate for : {uuid.UUID(bytes=job_status_update.job_uuid)}")
@@ -314,9 +493,11 @@ def job_status_update_process(job_status_update, method=None, properties=None):
         job.save()
         # Match workflow
         wfs = WorkflowStep.objects.get(current_job=job)
+        wf = lock_workflow(wfs.workflow_id)
+        if wf.state == "failed":
+            return # Its JobKill is on the way
         wfs.run()
         wfs.save()
-        wf = wfs.workflow
         if wf.state == "initalizing":
             wf.run()
             wf.save()
@@ -325,16 +506,25 @@ def job_status_update_process(job_status_update, method=None, properties=None):
         job.save()
         # Match workflow
         wfs = WorkflowStep.objects.get(current_job=job)
+        wf = lock_workflow(wfs.workflow_id)
+        if wf.state == "failed":
+            return
         wfs.complete()
         wfs.save()
-        wf = wfs.workflow
         if wf.state == "running":
             wf.check_complete()
     elif(job_status_update.job_status == JobStatus.JOB_STATUS_FAILED):
+        if job.state == "failed":
+            return # Heard already
         wfs = WorkflowStep.objects.get(current_job=job)
-        wf = wfs.workflow
+        wf = lock_workflow(wfs.workflow_id)
         job.fail()
         job.save()
+        if wf.state == "failed":
+            # Most likely one we killed
+            print(f"Job {job.uuid} of failed Workflow {wf.uuid} is down: "
+                  f"{job_status_update.status_info}")
+            return
         try:
             wfs.fulfill_again()
             print(f"Job {job.uuid} failed, retrying")
@@ -346,13 +536,44 @@ def job_status_update_process(job_status_update, method=None, properties=None):
             print(f"Job {job.uuid} failed, failing Workflow and Step")
             wfs.fail()
             wfs.save()
-            wf.fail()
-            wf.save()
+            fail_workflow(wf, f"Step {wfs.step_name} failed")
     elif(job_status_update.job_status == JobStatus.JOB_STATUS_PENDING):
         pass #NOOP as we should already be in pending (or beyond)
     else:
         print(f"JobStatusUpdate send unknown status {job_status_update.job_status}")
 
+def fail_workflow(wf, kill_info):
+    """
+    Fail a (locked) Workflow and everything still going in it.  Its live jobs
+    are sent a JobKill, so that agents can give their slots to someone else.
+    """
+    wf.fail()
+    wf.save()
+    wf.fail_steps()
+
+    live_jobs = Job.objects.filter(
+        workflow_step__workflow=wf, state__in=["pending", "queued", "running"])
+    for job in live_jobs:
+        send_job_kill(job, kill_info, workflow_uuid=str(wf.uuid))
+
+def send_job_kill(job, kill_info, workflow_uuid=None):
+    job_kill = JobKill(
+        signature=Signature(),
+        job_uuid=job.uuid.bytes,
+        kill_info=kill_info)
+    publish(job.reply_to, job_kill, correlation_id=workflow_uuid)
+    print(f"Sent JobKill for {job.uuid}: {kill_info}")
+
+def workflow_cancel(wf_cancel, method=None, properties=None):
+    workflow_uuid = to_uuid_obj(wf_cancel.workflow_uuid)
+    print(f" [x] Received WorkFlowCancel for : {workflow_uuid}")
+
+    wf = lock_workflow(workflow_uuid)
+    if wf.state in ("completed", "failed"):
+        print(f"Workflow {wf.uuid} is already {wf.state}")
+        return
+    fail_workflow(wf, f"Workflow cancelled: {wf_cancel.reason}")
+
 def create_send_job_request(step):
     """
     Take a WorkFlowStep, create the JobRequest object, and send off the message
@@ -360,65 +581,53 @@ def create_send_job_request(step):
     """
     jr = step.create_job_request() # TODO default state is fulfilling?
     jr.fulfill()
+    jr.deadline = timezone.now() + request_timeout(0)
     jr.save() # TODO Do we have the JR update the WFS?
+    schedule("request", jr.uuid, jr.deadline, step.workflow_id)
+
+    send_job_request(jr)
 
+def send_job_request(jr):
+    step = jr.workflow_step
     jfr = JobFulfillmentRequest(
         signature=Signature(),
         request_uuid=jr.uuid.bytes,
         job_type_name=step.job_name,
         parameters=workflow_kvs_to_proto_parameters(step.job_kvs))
 
-    print("Sending to wf.agent.fulfillment")
-    channel.basic_publish(
-        exchange=caroni_exchange,
-        properties=pika.BasicProperties(reply_to=get_manager_topic()),
-        routing_key='wf.agent.fulfillment',
-        body=sign_and_seal(jfr).SerializeToString())
+    # Only agents with a JobType of this name are listening
+    topic = fulfillment_topic(step.job_name)
+    print(f"Sending to {topic}")
+    publish(topic, jfr, correlation_id=str(step.workflow_id))
 
 def workflow_create(wfc, method=None, properties=None):
     print(f" [x] Received WorkFlowCreate for : {wfc.template_name}")
 
     wft = WorkflowTemplate.objects.get(name = wfc.template_name)
-    store['mem://workflow.cwl'] = wft.cwl_doc
-    workflow_inputs = {_.key: _.value for _ in wfc.inputs}
-    wf = Workflow.objects.create(
-        template=wft, cwl_doc=wft.cwl_doc, workflow_inputs=workflow_inputs)
-    ctx = LoadingContext()
-    ctx.fetcher_constructor = InMemoryFetcher
-    ctx.resolver = mem_resolver
-    ctx.construct_tool_object = default_make_tool
-    workflow_ast = load_tool("mem://workflow.cwl", loadingContext=ctx)
-
-    for step in workflow_ast.steps:
-        step_name = step.id.split("#")[1] # 0 is namespace
-        try:
-            wf.add_step(step_name, step)
-        except Exception as e:
-            print(e)
-
-    # Go around again to get dataflows.  Need to make sure all the steps existed
-    # first (previous for)
-    for step in workflow_ast.steps:
-        try:
-            wf.process_dataflows(step_name, step)
-        except Exception as e:
-            print(e)
-
-    # Turn any outputs into dataflows
-    wf.process_outputs(workflow_ast.tool['outputs'])
-
-    # Some what arbitrary doing this here, versus before scanning the AST above,
-    # but we should do it before we kick off JobRequests.
-    wf.initialize()
-    wf.save()
+    try:
+        plan = plan_cache.get(wft)
+    except TemplateCompileError as e:
+        print(f"WorkflowTemplate {wft.name} did not compile: {e}")
+        return
 
-    # Third go around but we use the WorkflowStep models now.  We fire off requests
-    # after we know DAG (we'll have the opportunity to calculate a time estimate at
-    # this point, which I speculate we'll need in the future).
-    for step in WorkflowStep.objects.filter(workflow=wf):
-        create_send_job_request(step)
-        step.fulfill()
-        step.save()
+    workflow_inputs = {_.key: _.value for _ in wfc.inputs}
+    with transaction.atomic():
+        wf = Workflow.objects.create(
+            template=wft, cwl_doc=wft.cwl_doc, workflow_inputs=workflow_inputs)
+        # Steps, dataflows (including outputs), and a JobRequest per step
+        request_deadline = timezone.now() + request_timeout(0)
+        job_requests = wf.instantiate(plan, request_deadline=request_deadline)
+
+        # We should do this before we kick off JobRequests.
+        wf.initialize()
+        wf.save()
+
+    # Fire off requests after we know DAG (we'll have the opportunity to
+    # calculate a time estimate at this point, which I speculate we'll need in
+    # the future).
+    for jr in job_requests:
+        send_job_request(jr)
+        schedule("request", jr.uuid, request_deadline, wf.uuid)
 
 def job_data_available_process(jda, method=None, properties=None):
     print(f" [x] Received JobDataAvailable for : {to_uuid_obj(jda.job_uuid)}")
@@ -429,31 +638,136 @@ def job_data_available_process(jda, method=None, properties=None):
         params_recv[param.key] = param.value
 
     # It will come FROM the source job
-    src_job = Job.objects.get(uuid=uuid_obj)
-    wfstep_src = src_job.workflow_step
-    for df in WorkflowDataflow.objects.filter(wfstep_src=wfstep_src):
+    wfstep_src = WorkflowStep.objects.get(current_job_id=uuid_obj)
+    wf = lock_workflow(wfstep_src.workflow_id)
+    outgoing = []
+    deliveries = []
+    wfouts = {}
+    dataflows = WorkflowDataflow.objects.filter(
+        wfstep_src=wfstep_src).select_related("wfstep_dst__current_job")
+    for df in dataflows:
 
         # Do we have the right input/output pair
         if df.src_output_name in params_recv.keys():
             if df.wfstep_dst: # a job to be notified
                 jp_key = df.dst_input_name
                 jp_value = params_recv[df.src_output_name]
-                job_uuid = df.wfstep_dst.current_job.uuid.bytes
-                job_routing_key = df.wfstep_dst.current_job.reply_to
-
-                send_job_data_available(
-                    jp_key=jp_key, jp_value=jp_value, job_uuid=job_uuid,
-                    job_routing_key=job_routing_key)
+                outgoing.append(
+                    (df.wfstep_dst.current_job, jp_key, jp_value))
             else: # Workflow itself
-                with transaction.atomic():
-                    wfouts = wfstep_src.workflow.workflow_outputs
-                    wfouts[df.dst_input_name] = params_recv[df.src_output_name]
-                    wfstep_src.workflow.workflow_outputs = wfouts
-                    wfstep_src.workflow.save()
+                wfouts[df.dst_input_name] = params_recv[df.src_output_name]
+
+            deliveries.append((df, params_recv[df.src_output_name]))
+
+    if wfouts:
+        wf.workflow_outputs = {**wf.workflow_outputs, **wfouts}
+        wf.save(update_fields=["workflow_outputs"])
+    WorkflowDataflow.deliver_many(deliveries)
+
+    send_job_data_available(outgoing, workflow_uuid=str(wf.uuid))
+
+
+### Deadlines; see timers.py
+def request_timeout(broadcasts):
+    # Twice as long each time the request is sent again
+    return timedelta(
+        seconds=settings.CARONI_MANAGER_REQUEST_TIMEOUT * 2 ** broadcasts)
+
+def schedule(kind, key, when, workflow_uuid):
+    """ Start a timer once the handler's transaction commits """
+    transaction.on_commit(
+        partial(timers.add, when, kind, key, str(workflow_uuid)))
+
+def request_deadline(jr_uuid, method=None, properties=None):
+    """
+    No agent has taken this JobRequest in time.  Send it again, waiting longer
+    each time, and after CARONI_MANAGER_REQUEST_REBROADCASTS tries fail its step
+    and Workflow.
+    """
+    jr = JobRequest.objects.select_related("workflow_step").get(uuid=jr_uuid)
+    wf = lock_workflow(jr.workflow_step.workflow_id)
+    # Again, now that no other handler can change it underneath us
+    jr = JobRequest.objects.select_related("workflow_step").get(uuid=jr_uuid)
+    now = timezone.now()
+    if jr.state != "fulfilling" or jr.deadline is None or jr.deadline > now:
+        return # Taken, or already sent again
+    wfs = jr.workflow_step
+
+    if wf.state in ("completed", "failed") or wfs.state == "failed":
+        jr.give_up()
+        jr.save()
+    elif jr.broadcasts < settings.CARONI_MANAGER_REQUEST_REBROADCASTS:
+        jr.broadcasts += 1
+        jr.deadline = now + request_timeout(jr.broadcasts)
+        jr.save(update_fields=["broadcasts", "deadline"])
+        print(f"JobRequest {jr.uuid} not taken, sending again ({jr.broadcasts})")
+        send_job_request(jr)
+        schedule("request", jr.uuid, jr.deadline, wf.uuid)
+    else:
+        print(f"JobRequest {jr.uuid} not taken, failing Workflow and Step")
+        jr.give_up()
+        jr.save()
+        wfs.fail()
+        wfs.save()
+        fail_workflow(
+            wf, f"No agent took step {wfs.step_name} "
+                f"after {jr.broadcasts + 1} requests")
+
+def offer_deadline(offer_uuid, method=None, properties=None):
+    """
+    We accepted this offer, but the agent's JobAccepted never came (it went
+    away, say).  Drop the offer and ask for the step again.
+    """
+    jo = JobOffer.objects.select_related("job_request__workflow_step").get(
+        uuid=offer_uuid)
+    wf = lock_workflow(jo.job_request.workflow_step.workflow_id)
+    jo = JobOffer.objects.select_related("job_request__workflow_step").get(
+        uuid=offer_uuid)
+    if (jo.state != "accepted" or jo.deadline is None
+            or jo.deadline > timezone.now()):
+        return # JobAccepted came
+    jr = jo.job_request
+    wfs = jr.workflow_step
+    print(f"No JobAccepted for offer {jo.uuid}, dropping it")
+    jo.expire()
+    jo.save()
+    jr.expire()
+    jr.save()
+
+    if wf.state == "failed" or wfs.state != "fulfilling":
+        return
+    if wfs.can_fulfill_again():
+        wfs.attempts += 1
+        wfs.save(update_fields=["attempts"])
+        create_send_job_request(wfs)
+    else:
+        wfs.fail()
+        wfs.save()
+        fail_workflow(wf, f"Step {wfs.step_name} was never taken up")
 
-            df.deliver(value=params_recv[df.src_output_name])
-            df.save()
+timer_routes = {
+    "request": request_deadline,
+    "offer": offer_deadline,
+}
 
+def restore_timers():
+    """ Put back the deadlines that were pending when we last stopped """
+    requests = JobRequest.objects.filter(
+        state="fulfilling", deadline__isnull=False).values_list(
+            "uuid", "deadline", "workflow_step__workflow_id")
+    offers = JobOffer.objects.filter(deadline__isnull=False).values_list(
+        "uuid", "deadline", "job_request__workflow_step__workflow_id")
+    for kind, rows in (("request", requests), ("offer", offers)):
+        for key, when, workflow_uuid in rows:
+            timers.add(when, kind, key, str(workflow_uuid))
+    print(f"Restored {len(timers)} timers")
+
+def run_timer(kind, key):
+    try:
+        handle(f"timer.{kind}", key, timer_routes[kind])
+    except Exception:
+        # Its deadline is still in the database for the next restart
+        logger.exception("Timer %s for %s failed", kind, key)
 
 callback_routes = {
     JobFulfillmentDecline: jfr_decline_process,
@@ -462,45 +776,123 @@ callback_routes = {
     JobStatusUpdate: job_status_update_process,
     WorkFlowCreate: workflow_create,
     JobDataAvailable: job_data_available_process,
+    WorkFlowCancel: workflow_cancel,
 }
 
-def callback(ch, method, properties, body):
-    envelope = CaroniEnvelope()
-    envelope.ParseFromString(body)
-
-    any_payload = envelope.payload
-
-    for msg_type, handler in callback_routes.items():
-        if any_payload.Is(msg_type.DESCRIPTOR):
-            # Unpack into the correct type
-            unpacked = msg_type()
-            any_payload.Unpack(unpacked)
-            handler(unpacked, method=method, properties=properties)
-            break
-    else:
-        print(f"Unknown routing key: {method.routing_key}")
-
-
-declare_result = channel.queue_declare(queue="", exclusive=True)
-wf_server_queue_name = declare_result.method.queue
+dispatcher = Dispatcher(callback_routes)
 
+def handle(type_name, msg, handler, method=None, properties=None):
+    """
+    Run a handler in a transaction.  If another manager worker changed the
+    same state underneath it (ConcurrentTransition), roll back and run it
+    again.  Anything it publish()es is only sent on commit, so a rolled back
+    attempt sends nothing.
 
-channel.queue_bind(
-    exchange=caroni_exchange,
-    queue=wf_server_queue_name,
-    routing_key=get_manager_topic()
-)
-
-print(f"Bound to queue with topic: {get_manager_topic()}")
+    How many queries each handler may make is checked by
+    `manage.py check_query_budgets`, not here.
+    """
+    for attempt in range(1, settings.CARONI_MANAGER_RETRIES + 1):
+        try:
+            with outbound.collect(), transaction.atomic():
+                dispatcher.handle(
+                    type_name, msg, handler,
+                    method=method, properties=properties)
+            return
+        except ConcurrentTransition:
+            if attempt == settings.CARONI_MANAGER_RETRIES:
+                raise
+            print(f"{type_name} raced another worker, retrying ({attempt})")
+
+def handler_failed(method, type_name):
+    """
+    Log the exception being handled, and say whether to requeue the message.
+    A failed message gets one more go (perhaps on another worker) and is then
+    dropped.
+    """
+    requeue = not method.redelivered
+    logger.exception(
+        "Handler for %s failed, %s", type_name,
+        "requeueing" if requeue else "dropping")
+    return requeue
 
-# Set up queue to listen for fulfillment decline response
-channel.basic_consume(
-    queue=wf_server_queue_name,
-    auto_ack=True,
-    on_message_callback=callback)
+def callback(ch, method, properties, body):
+    type_name, msg, handler = dispatcher.unpack(body, method=method)
+    if handler is not None:
+        try:
+            handle(
+                type_name, msg, handler, method=method, properties=properties)
+        except Exception:
+            ch.basic_nack(
+                method.delivery_tag,
+                requeue=handler_failed(method, type_name))
+            return
+    # By now the handler has committed and everything it sent is confirmed
+    ch.basic_ack(method.delivery_tag)
+
+def run_blocking():
+    global manager_identity, transport
+
+    parameters = amqp_parameters()
+    for attempt in range(1, 5):
+        try:
+            connection = pika.BlockingConnection(parameters)
+            break
+        except pika.exceptions.AMQPConnectionError:
+            print(f"RabbitMQ not ready (attempt {attempt}/5")
+            sleep(2)
+
+    channel = connection.channel()
+    channel.basic_qos(prefetch_count=settings.CARONI_MANAGER_PREFETCH)
+    channel.confirm_delivery()
+    channel.exchange_declare(caroni_exchange, exchange_type="topic")
+
+    manager_identity = ManagerIdentity.load()
+
+    topology = ManagerTopology(get_manager_topic())
+    for method, kwargs in topology.declarations:
+        getattr(channel, method)(**kwargs)
+
+    transport = BlockingTransport(channel, topology)
+    restore_timers()
+
+    def tick():
+        for kind, key, _ in timers.due():
+            run_timer(kind, key)
+        connection.call_later(settings.CARONI_MANAGER_TIMER_TICK, tick)
+    tick()
+
+    def log_stats():
+        print(f"Handled so far: {dispatcher.summary()}")
+        print(f"Published so far: {outbound.summary()}")
+        connection.call_later(settings.CARONI_MANAGER_STATS_INTERVAL, log_stats)
+    if settings.CARONI_MANAGER_STATS_INTERVAL > 0:
+        connection.call_later(settings.CARONI_MANAGER_STATS_INTERVAL, log_stats)
+
+    print(f"Bound to {topology.queues} with topic: {get_manager_topic()}")
+
+    # kill -HUP to pick up a changed WorkflowSite.  Signal handlers can land in
+    # the middle of anything, so just hand the reload to the connection to run.
+    signal.signal(
+        signal.SIGHUP,
+        lambda signum, frame: connection.add_callback_threadsafe(
+            reload_manager_identity))
+
+    for queue in topology.queues:
+        channel.basic_consume(
+            queue=queue,
+            on_message_callback=callback)
 
+    try:
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        connection.close()
+
+def main():
+    if settings.CARONI_MANAGER_MODE == "asyncio":
+        import wf_server_async
+        wf_server_async.run()
+    else:
+        run_blocking()
 
-try:
-    channel.start_consuming()
-except KeyboardInterrupt:
-    connection.close()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
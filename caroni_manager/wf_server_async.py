@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+The asyncio flavour of wf_server.py, run with CARONI_MANAGER_MODE=asyncio.
+
+Messages are consumed on an asyncio loop (pika's AsyncioConnection) and their
+handlers, which are all Django ORM, run on a bounded pool of threads.  Messages
+for different Workflows are handled concurrently, while messages for the same
+Workflow are handled one at a time in the order they arrived.  A slow handler
+(a big WorkFlowCreate, a slow database) only holds up its own Workflow.
+Deadlines (timers.py) are run the same way, in line with their Workflow's
+messages.
+"""
+import asyncio
+import logging
+import signal
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import monotonic
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+import wf_server
+from wf_server import caroni_exchange, dispatcher, get_manager_topic
+from gen.workflow_messages_pb2 import (
+    JobFulfillmentDecline, JobFulfillmentOffer, JobAccepted, JobStatusUpdate,
+    JobDataAvailable, WorkFlowCreate, WorkFlowCancel)
+
+from caroni.models import JobRequest, JobOffer, WorkflowStep
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+logger = logging.getLogger(__name__)
+
+class WorkflowKeys:
+    """
+    Works out which Workflow a message is for, which is what we order on.
+
+    A JobFulfillmentOffer names both its request and its offer, and a
+    JobAccepted both its offer and its job, so we remember offers and jobs as
+    those go by.  That way a message can be keyed before the handler for an
+    earlier message has committed the rows it refers to.  The database is the
+    fallback (after a restart, say).
+
+    Only ever called from the one thread, in the order messages arrived.
+    """
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.offers = OrderedDict()
+        self.jobs = OrderedDict()
+
+    def remember(self, cache, key, workflow_uuid):
+        if workflow_uuid is None:
+            return
+        cache[key] = workflow_uuid
+        cache.move_to_end(key)
+        while len(cache) > self.maxsize:
+            cache.popitem(last=False)
+
+    def lookup(self, queryset, field):
+        workflow_uuid = queryset.values_list(field, flat=True).first()
+        # Same form as a correlation_id
+        return str(workflow_uuid) if workflow_uuid is not None else None
+
+    def key_for(self, msg, properties):
+        """
+        Returns the Workflow uuid for msg, or None if it doesn't need ordering
+        against anything.
+        """
+        # Agents echo back the Workflow uuid we send them
+        if properties is not None and properties.correlation_id:
+            return properties.correlation_id
+
+        close_old_connections()
+
+        if isinstance(msg, WorkFlowCreate):
+            return None # A brand new Workflow
+
+        if isinstance(msg, WorkFlowCancel):
+            return str(wf_server.to_uuid_obj(msg.workflow_uuid))
+
+        if isinstance(msg, (JobFulfillmentOffer, JobFulfillmentDecline)):
+            workflow_uuid = self.lookup(JobRequest.objects.filter(
+                uuid=wf_server.to_uuid_obj(msg.request_uuid)),
+                "workflow_step__workflow_id")
+            if isinstance(msg, JobFulfillmentOffer):
+                self.remember(self.offers, msg.offer_uuid, workflow_uuid)
+            return workflow_uuid
+
+        if isinstance(msg, JobAccepted):
+            workflow_uuid = self.offers.get(msg.offer_uuid)
+            if workflow_uuid is None:
+                workflow_uuid = self.lookup(JobOffer.objects.filter(
+                    uuid=wf_server.to_uuid_obj(msg.offer_uuid)),
+                    "job_request__workflow_step__workflow_id")
+            self.remember(self.jobs, msg.job_uuid, workflow_uuid)
+            return workflow_uuid
+
+        if isinstance(msg, (JobStatusUpdate, JobDataAvailable)):
+            workflow_uuid = self.jobs.get(msg.job_uuid)
+            if workflow_uuid is None:
+                workflow_uuid = self.lookup(WorkflowStep.objects.filter(
+                    current_job_id=wf_server.to_uuid_obj(msg.job_uuid)),
+                    "workflow_id")
+                self.remember(self.jobs, msg.job_uuid, workflow_uuid)
+            return workflow_uuid
+
+        return None
+
+class AsyncTransport:
+    """
+    Sends messages for the handlers.  Handlers run on worker threads and pika
+    channels aren't thread safe, so everything is handed to the loop.
+
+    The channel is in confirm mode, but nothing waits on a publish.  The broker
+    confirms them as it goes, often many at once, and a consumed message is
+    acked once everything published up to the end of its handler has been
+    confirmed.
+    """
+    def __init__(self, loop, channel, topology):
+        self.loop = loop
+        self.channel = channel
+        self.topology = topology
+        # Delivery tag of our last publish; the broker numbers them from 1
+        self.published = 0
+        self.unconfirmed = set()
+        # (self.published when its handler finished, consumed delivery tag)
+        self.acks = deque()
+        # Delivery tag of the last message of a flush -> when it was flushed
+        self.flushed_at = {}
+
+    def publish(self, routing_key, body, correlation_id=None):
+        self.loop.call_soon_threadsafe(
+            self._publish, routing_key, body, correlation_id)
+
+    def publish_many(self, messages):
+        # One wake up of the loop for the whole lot
+        self.loop.call_soon_threadsafe(
+            self._publish_many, messages, monotonic())
+
+    def _publish_many(self, messages, flushed_at):
+        for routing_key, body, correlation_id in messages:
+            self._publish(routing_key, body, correlation_id)
+        # The flush is confirmed once its last message is
+        self.flushed_at[self.published] = flushed_at
+
+    def _publish(self, routing_key, body, correlation_id):
+        self.channel.basic_publish(
+            exchange=caroni_exchange,
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(
+                reply_to=get_manager_topic(),
+                correlation_id=correlation_id))
+        self.published += 1
+        self.unconfirmed.add(self.published)
+
+    def on_confirm(self, frame):
+        tag = frame.method.delivery_tag
+        if frame.method.multiple:
+            confirmed = {t for t in self.unconfirmed if t <= tag}
+        else:
+            confirmed = {tag}
+        self.unconfirmed -= confirmed
+        now = monotonic()
+        for tag in confirmed & self.flushed_at.keys():
+            flushed_at = self.flushed_at.pop(tag)
+            wf_server.outbound.confirmed(now - flushed_at)
+        if isinstance(frame.method, pika.spec.Basic.Nack):
+            # Nothing to be done by then; the handler has committed
+            logger.error("Broker lost %d published message(s)", len(confirmed))
+        self.send_acks()
+
+    def ack(self, delivery_tag):
+        # Called after the handler's publishes, so they're ahead of us
+        self.loop.call_soon_threadsafe(self._ack, delivery_tag)
+
+    def _ack(self, delivery_tag):
+        self.acks.append((self.published, delivery_tag))
+        self.send_acks()
+
+    def send_acks(self):
+        oldest = min(self.unconfirmed, default=self.published + 1)
+        while self.acks and self.acks[0][0] < oldest:
+            _, delivery_tag = self.acks.popleft()
+            self.channel.basic_ack(delivery_tag)
+
+    def nack(self, delivery_tag, requeue):
+        self.loop.call_soon_threadsafe(partial(
+            self.channel.basic_nack, delivery_tag, requeue=requeue))
+
+    def rebind(self, old_topic, new_topic):
+        self.loop.call_soon_threadsafe(self._rebind, old_topic, new_topic)
+
+    def _rebind(self, old_topic, new_topic):
+        for method, kwargs in (self.topology.bind_call(new_topic),
+                               self.topology.unbind_call(old_topic)):
+            getattr(self.channel, method)(**kwargs)
+
+class AsyncManager:
+    def __init__(self, loop):
+        self.loop = loop
+        self.pool = ThreadPoolExecutor(
+            max_workers=settings.CARONI_MANAGER_THREADS,
+            thread_name_prefix="handler")
+        # Keys are worked out one message at a time, in arrival order
+        self.key_pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="keys")
+        self.keys = WorkflowKeys()
+        self.arrivals = asyncio.Queue()
+        # Workflow uuid -> the task for the last message seen for it
+        self.tails = {}
+        self.connection = None
+        self.channel = None
+        self.topology = None
+        self.transport = None
+        self.attempt = 0
+
+    ## Connection set up; each step is a pika callback of the last
+    def connect(self):
+        self.attempt += 1
+        self.connection = AsyncioConnection(
+            parameters=wf_server.amqp_parameters(),
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
+            on_close_callback=self.on_connection_closed,
+            custom_ioloop=self.loop)
+
+    def on_connection_open_error(self, connection, err):
+        if self.attempt >= 5:
+            print(f"RabbitMQ not ready, giving up: {err}")
+            self.loop.stop()
+            return
+        print(f"RabbitMQ not ready (attempt {self.attempt}/5")
+        self.loop.call_later(2, self.connect)
+
+    def on_connection_closed(self, connection, reason):
+        print(f"Connection closed: {reason}")
+        self.loop.stop()
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        self.channel = channel
+        self.topology = wf_server.ManagerTopology(get_manager_topic())
+        self.transport = AsyncTransport(self.loop, channel, self.topology)
+        channel.basic_qos(
+            prefetch_count=settings.CARONI_MANAGER_PREFETCH,
+            callback=self.on_qos)
+
+    def on_qos(self, frame):
+        self.channel.confirm_delivery(
+            ack_nack_callback=self.transport.on_confirm,
+            callback=self.on_confirm_mode)
+
+    def on_confirm_mode(self, frame):
+        self.channel.exchange_declare(
+            exchange=caroni_exchange,
+            exchange_type="topic",
+            callback=self.on_exchange_declared)
+
+    def on_exchange_declared(self, frame):
+        self.declare(0)
+
+    def declare(self, index, frame=None):
+        # Walk topology.declarations one callback at a time
+        if index == len(self.topology.declarations):
+            self.on_declared()
+            return
+        method, kwargs = self.topology.declarations[index]
+        getattr(self.channel, method)(
+            callback=partial(self.declare, index + 1), **kwargs)
+
+    def on_declared(self):
+        wf_server.transport = self.transport
+        print(f"Bound to {self.topology.queues} with topic: {get_manager_topic()}")
+        for queue in self.topology.queues:
+            self.channel.basic_consume(
+                queue=queue,
+                on_message_callback=self.on_message)
+        self.tick()
+        if settings.CARONI_MANAGER_STATS_INTERVAL > 0:
+            self.loop.call_later(
+                settings.CARONI_MANAGER_STATS_INTERVAL, self.log_stats)
+
+    def on_message(self, channel, method, properties, body):
+        self.arrivals.put_nowait((method, properties, body))
+
+    ## Handling
+    async def sequence(self):
+        """
+        Takes messages in arrival order, keys them, and starts each one's
+        handler once the previous message for the same Workflow is done.
+        """
+        while True:
+            method, properties, body = await self.arrivals.get()
+            type_name, msg, handler = dispatcher.unpack(body, method=method)
+            if handler is None:
+                self.transport.ack(method.delivery_tag)
+                continue
+
+            key = await self.loop.run_in_executor(
+                self.key_pool, self.keys.key_for, msg, properties)
+            previous = self.tails.get(key) if key is not None else None
+
+            self.follow(key, self.handle(
+                previous, type_name, msg, handler, method, properties))
+
+    def tick(self):
+        for kind, key, workflow_uuid in wf_server.timers.due():
+            self.follow(workflow_uuid, self.fire(
+                self.tails.get(workflow_uuid), kind, key))
+        self.loop.call_later(settings.CARONI_MANAGER_TIMER_TICK, self.tick)
+
+    async def fire(self, previous, kind, key):
+        if previous is not None:
+            await asyncio.wait([previous])
+        await self.loop.run_in_executor(self.pool, self.run_timer, kind, key)
+
+    def run_timer(self, kind, key):
+        close_old_connections()
+        try:
+            wf_server.run_timer(kind, key)
+        finally:
+            close_old_connections()
+
+    def follow(self, key, coro):
+        """ Run coro as the last task for the Workflow """
+        task = self.loop.create_task(coro)
+        if key is not None:
+            self.tails[key] = task
+            task.add_done_callback(partial(self.forget_tail, key))
+
+    def log_stats(self):
+        print(f"Handled so far: {dispatcher.summary()}")
+        print(f"Published so far: {wf_server.outbound.summary()}")
+        self.loop.call_later(
+            settings.CARONI_MANAGER_STATS_INTERVAL, self.log_stats)
+
+    def forget_tail(self, key, task):
+        if self.tails.get(key) is task:
+            del self.tails[key]
+
+    async def handle(self, previous, type_name, msg, handler, method,
+                     properties):
+        if previous is not None:
+            await asyncio.wait([previous])
+        await self.loop.run_in_executor(
+            self.pool, self.run_handler, type_name, msg, handler, method,
+            properties)
+
+    def run_handler(self, type_name, msg, handler, method, properties):
+        close_old_connections()
+        try:
+            wf_server.handle(
+                type_name, msg, handler, method=method, properties=properties)
+        except Exception:
+            # One bad message shouldn't take the manager down with it
+            self.transport.nack(
+                method.delivery_tag,
+                wf_server.handler_failed(method, type_name))
+        else:
+            self.transport.ack(method.delivery_tag)
+        finally:
+            close_old_connections()
+
+    def reload(self):
+        # kill -HUP; see wf_server.reload_manager_identity()
+        self.loop.run_in_executor(
+            self.key_pool, wf_server.reload_manager_identity)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+        self.key_pool.shutdown(wait=True)
+
+def run():
+    wf_server.manager_identity = wf_server.ManagerIdentity.load()
+    wf_server.restore_timers()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    manager = AsyncManager(loop)
+    manager.connect()
+    loop.create_task(manager.sequence())
+    loop.add_signal_handler(signal.SIGHUP, manager.reload)
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.shutdown()
+        if manager.connection is not None and manager.connection.is_open:
+            manager.connection.close()
+
+if __name__ == "__main__":
+    run()